@@ -1,40 +1,119 @@
 import random
 import numpy as np
-import tensorflow as tf
 import time
-import pygame
-from collections import deque
-from keras.models import Sequential, save_model, load_model
-from keras.layers import Dense
-from tetris_game import TetrisGame,Input
-from renderer import Renderer
+import tracing
+import telemetry
+import checkpoint
+import json
+import os
+from tetris_game import TetrisGame,Input,AfterstateCache
+from viewer import ViewerProcess, HeadlessRenderer
+from finesse import play_inputs
+import sys
+
+# TensorFlow, Keras and pygame take seconds to import, so they are imported
+# where they are first needed instead of here
 
 
 
 
 MAX_MEMORY = 100_000
-BATCH_SIZE = 1000
+BATCH_SIZE = 64 # Transitions per minibatch update
 LR = 0.001
+TRAIN_EVERY = 1 # Placements between minibatch updates
+TARGET_SYNC_EVERY = 500 # Updates between copies of the model into the target network
+CHECKPOINT_INTERVAL = 600 # Seconds between checkpoints when checkpointing is on
+BOOTSTRAP_GAMES = 20 # Heuristic games played to fill the memory in bootstrap mode
+BOOTSTRAP_PIECES = 500 # Piece cap for each of those games
+PRETRAIN_EPOCHS = 10 # Passes over the bootstrapped memory before epsilon-greedy training
+PRETRAIN_EPSILON = 0.1 # Starting epsilon once pretrained, as the network already plays like the heuristic
+
+class ReplayMemory:
+    '''
+    Ring buffer of (state, next_state, reward, done) transitions kept in
+    preallocated arrays, so sampling a minibatch costs the same however full
+    the memory is.
+    '''
+    def __init__(self, capacity, state_size):
+        self.capacity = capacity
+        self.states = np.zeros((capacity, state_size), dtype=np.float32)
+        self.next_states = np.zeros((capacity, state_size), dtype=np.float32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.bool_)
+        self.size = 0
+        self.position = 0
+
+    def append(self, transition):
+        state, next_state, reward, done = transition
+        i = self.position
+        self.states[i] = state
+        self.next_states[i] = next_state
+        self.rewards[i] = reward
+        self.dones[i] = done
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size):
+        # Uniform with replacement, the usual choice for DQN
+        indices = np.random.randint(0, self.size, batch_size)
+        return (self.states[indices], self.next_states[indices],
+                self.rewards[indices], self.dones[indices])
+
+    def __len__(self):
+        return self.size
+
+    def save(self, path):
+        np.savez(path, states=self.states[:self.size],
+                 next_states=self.next_states[:self.size],
+                 rewards=self.rewards[:self.size], dones=self.dones[:self.size],
+                 position=self.position)
+
+    def load(self, path):
+        with np.load(path) as arrays:
+            self.size = len(arrays['rewards'])
+            self.states[:self.size] = arrays['states']
+            self.next_states[:self.size] = arrays['next_states']
+            self.rewards[:self.size] = arrays['rewards']
+            self.dones[:self.size] = arrays['dones']
+            self.position = int(arrays['position'])
 
 class DQNAgent:
-    def __init__(self, state_size, action_size):
+    def __init__(self, state_size, action_size, batch_size=BATCH_SIZE,
+                 train_every=TRAIN_EVERY, target_sync_every=TARGET_SYNC_EVERY,
+                 epsilon_decay=0.05, epsilon_schedule="linear",
+                 epsilon_min=0.01):
         self.state_size = state_size #The Number of State Information - Positon and Rotation as well as board statistics which gives 6
         self.action_size = action_size #Action Size are possible actions which will be rotate clockwise, move left, and move right
 
-        self.memory = deque(maxlen=MAX_MEMORY) #Storing memories that can be replayed to train the Deep Q Network
+        self.memory = ReplayMemory(MAX_MEMORY, state_size) #Storing memories that can be replayed to train the Deep Q Network
         self.gamma = 0.95 # The discount factor that discounts prospective rewards in future steps
         self.epsilon = 1.0 # The factor that determins what portion of agents move are random
-        self.epsilon_decay = 0.05 # Exploration rate that decays to allow agent to use info it learned
-        self.epsilon_min = 0.01 # Minimmum for exploration rate given its 0.01 the agent only explores 1% of time and uses exp other 99%
-        self.learning_rate = 0.001 #
+        self.epsilon_decay = epsilon_decay # Exploration rate that decays to allow agent to use info it learned
+        self.epsilon_schedule = epsilon_schedule # "linear" subtracts epsilon_decay per episode, "exponential" multiplies by 1 - epsilon_decay
+        self.epsilon_min = epsilon_min # Minimmum for exploration rate given its 0.01 the agent only explores 1% of time and uses exp other 99%
+        self.learning_rate = LR #
+        self.batch_size = batch_size # Transitions per minibatch update
+        self.train_every = train_every # Placements between minibatch updates
+        self.target_sync_every = target_sync_every # Updates between target network syncs
+        self.updates = 0 # Minibatch updates so far
+        self.train_time = 0.0 # Seconds spent in those updates
+        self.verbose = False # Print the values of the states being compared
         self.model = self._build_model()
+        # Frozen copy of the model used for the Bellman targets, synced every
+        # target_sync_every updates to keep the targets from chasing the model
+        self.target_model = self._build_model()
+        self.target_model.set_weights(self.model.get_weights())
 
     def _build_model(self):
+        from keras.models import Sequential
+        from keras.layers import Dense
+        from keras.optimizers import Adam
+
         model = Sequential()
         model.add(Dense(32,activation="relu",input_dim=self.state_size))
         model.add(Dense(32,activation="relu"))
         model.add(Dense(self.action_size,activation="linear"))
-        model.compile(loss="mse",optimizer=tf.keras.optimizers.Adam(lr=self.learning_rate))
+        model.compile(loss="mse",optimizer=Adam(learning_rate=self.learning_rate))
         return model
     
     def remember(self, state, next_state, reward, done):
@@ -45,10 +124,11 @@ class DQNAgent:
         if np.random.random() <= self.epsilon:
             return random.randrange(self.action_size)
         else:
-            return np.argmax(self.model.predict(state))
+            return np.argmax(self.model.predict(state, verbose=0))
     
     def predict_val(self,state):
-        return self.model.predict(state)[0]
+        with tracing.span('predict'):
+            return self.model.predict(state, verbose=0)[0]
     
     def select_state(self, states):
         max_value = None
@@ -62,7 +142,8 @@ class DQNAgent:
                 temp_max_val_sum = 0
                 if (count == 0):
                     val = self.predict_val(np.reshape(state,[1,self.state_size]))
-                    print("The value is", val)
+                    if self.verbose:
+                        print("The value is", val)
                     count = count + 1
                     max_val = val
                     best_state = state
@@ -76,114 +157,317 @@ class DQNAgent:
         return best_state
 
     
-    def train(self,batch_size):
-        batch_sample = random.sample(self.memory, batch_size)
-        next_states = np.array([x[1] for x in batch_sample])
-        next_qs = [x[0] for x in self.model.predict(next_states)]
-        x=[]
-        y=[]
-        
-        for i,(state,__,reward,done) in enumerate(batch_sample):
-            if (not done):
-                new_q = reward + self.gamma * next_qs[i]
-            else:
-                new_q = reward
-            x.append(state)
-            y.append(new_q)
-        
-        self.model.fit(np.array(x),np.array(y),batch_size=batch_size,epochs=3,verbose=0)
+    def train(self):
+        # One gradient step on a random minibatch. Returns the loss, or None
+        # while there are fewer transitions than a minibatch.
+        if len(self.memory) < self.batch_size:
+            return None
+        with tracing.span('train'):
+            return self._train()
+
+    def _train(self):
+        start = time.perf_counter()
+        states, next_states, rewards, dones = self.memory.sample(self.batch_size)
+        next_qs = self.target_model(next_states, training=False).numpy()[:, 0]
+        targets = rewards + self.gamma * next_qs * (1 - dones)
+        # Every output is regressed onto the same target, as before
+        loss = self.model.train_on_batch(states, targets[:, None])
+        self.updates += 1
+        if self.updates % self.target_sync_every == 0:
+            self.target_model.set_weights(self.model.get_weights())
+        self.train_time += time.perf_counter() - start
+        return float(np.mean(loss))
+
+    def observe_placement(self, placements):
+        # Called after every remembered placement; trains at a fixed cadence
+        if placements % self.train_every == 0:
+            return self.train()
+        return None
 
-        if self.epsilon > self.epsilon_min:
+    def decay_epsilon(self):
+        # Called once per episode
+        if self.epsilon_schedule == "exponential":
+            self.epsilon *= 1 - self.epsilon_decay
+        else:
             self.epsilon -= self.epsilon_decay
+        self.epsilon = max(self.epsilon, self.epsilon_min)
+
+    def get_updates_per_second(self):
+        return self.updates / self.train_time if self.train_time > 0 else 0.0
+
+    def pretrain(self, epochs):
+        # Fit the value network on whatever is in memory (e.g. bootstrapped
+        # heuristic games) without spending any of the exploration schedule
+        for _ in range(epochs * len(self.memory) // self.batch_size):
+            self.train()
+        self.target_model.set_weights(self.model.get_weights())
+
+    def save(self, path):
+        # Model with its optimizer state, target network, memory and
+        # counters, into an existing directory
+        self.model.save(os.path.join(path, "model.keras"))
+        np.savez(os.path.join(path, "target.npz"), *self.target_model.get_weights())
+        self.memory.save(os.path.join(path, "memory.npz"))
+        with open(os.path.join(path, "agent.json"), "w") as file:
+            json.dump({"epsilon": self.epsilon, "updates": self.updates,
+                       "train_time": self.train_time}, file)
 
-def main() -> None:
+    def load(self, path):
+        from keras.models import load_model
+
+        self.model = load_model(os.path.join(path, "model.keras"))
+        with np.load(os.path.join(path, "target.npz")) as arrays:
+            self.target_model.set_weights([arrays[f"arr_{i}"] for i in range(len(arrays.files))])
+        self.memory.load(os.path.join(path, "memory.npz"))
+        with open(os.path.join(path, "agent.json")) as file:
+            state = json.load(file)
+        self.epsilon = state["epsilon"]
+        self.updates = state["updates"]
+        self.train_time = state["train_time"]
+
+def bootstrap_memory(agent, games, max_pieces, weights=(6, 1, 1), cache=None):
+    '''
+    Fills the agent's memory with transitions from headless games played by
+    the simple AI, so training does not start from random placements that
+    top out in a few pieces. Transitions have the same form as in main. The
+    heuristic picks among the placements get_next_state offers, which are
+    the agent's own actions. Returns the number of transitions added.
+    '''
+    from simple_ai import get_utility, move
+
+    added = 0
+    for _ in range(games):
+        game = TetrisGame(60)
+        current_state = game.get_board_statistics()
+        while not game.is_over() and game.get_drops() < max_pieces:
+            next_state = game.get_next_state(cache)
+            if not next_state:
+                break
+            best_action = max(next_state, key=lambda action: get_utility(
+                game, action[0], action[1], *weights))
+            result = move(game, best_action[0], best_action[1])
+            agent.remember(current_state, next_state[best_action],
+                           game.get_score(), result.game_over)
+            current_state = next_state[best_action]
+            added += 1
+    return added
+
+def main(args) -> None:
     print("Hit loop")
+    # trace or trace=PATH records where the time goes, see tracing.py
+    tracing.enable_from_args(args[1:])
+    verbose = 'verbose' in args[1:]
     game = TetrisGame(60) 
-    renderer = Renderer(game)
+    # In viewer mode the window is drawn by its own process, so frames never
+    # wait on model.predict
+    viewer_mode = 'viewer' in args[1:]
+    # In headless mode nothing is drawn and pygame is never loaded
+    headless = 'headless' in args[1:]
+    if headless:
+        renderer = HeadlessRenderer(game)
+    elif viewer_mode:
+        renderer = ViewerProcess(game)
+    else:
+        from renderer import Renderer
+        import pygame
+        renderer = Renderer(game)
     renderer.setup()
     agent = DQNAgent(4,5)
+    agent.verbose = verbose
+    state_cache = AfterstateCache(100_000)
+    # checkpoint or checkpoint=DIR saves everything needed to continue
+    # training every CHECKPOINT_INTERVAL seconds and at exit, resume starts
+    # from the latest checkpoint
+    checkpoint_dir = checkpoint.get_directory(args[1:], "checkpoints/agent")
+    placements = 0
+    resumed = None
+    if 'resume' in args[1:]:
+        resumed = checkpoint.get_latest(checkpoint_dir)
+    # metrics or metrics=PATH writes episode and training records as JSONL,
+    # see telemetry.py. A resumed run adds to the records it already wrote.
+    # verbose prints every decision.
+    metrics = telemetry.from_args(args[1:], append=resumed is not None)
+    if resumed is not None:
+        agent.load(resumed)
+        checkpoint.load_random_state(resumed)
+        with open(os.path.join(resumed, "run.json")) as file:
+            run = json.load(file)
+        placements = run["placements"]
+        # Checkpoints from before the counters were saved start them at 0
+        metrics.episodes = run.get("episodes", 0)
+        metrics.updates = run.get("updates", 0)
+        game.reset()
+        print("Resumed from", resumed)
+        metrics.log('resume', path=resumed, updates=agent.updates,
+                    epsilon=agent.epsilon, memory=len(agent.memory))
+    last_checkpoint = time.perf_counter()
+
+    def save_checkpoint():
+        def write(path):
+            agent.save(path)
+            checkpoint.save_random_state(path)
+            with open(os.path.join(path, "run.json"), "w") as file:
+                json.dump({"placements": placements,
+                           "episodes": metrics.episodes,
+                           "updates": metrics.updates}, file)
+        with tracing.span('checkpoint'):
+            path = checkpoint.save(checkpoint_dir, write)
+        metrics.log('checkpoint', path=path, updates=agent.updates)
+
+    # Bootstrap mode starts from heuristic play instead of an empty memory,
+    # and optionally pretrains on it. A resumed memory already has it.
+    if 'bootstrap' in args[1:] and resumed is None:
+        with tracing.span('bootstrap'):
+            added = bootstrap_memory(agent, BOOTSTRAP_GAMES, BOOTSTRAP_PIECES,
+                                     cache=state_cache)
+        print("Bootstrapped transitions:", added)
+        metrics.log('bootstrap', transitions=added)
+        if 'pretrain' in args[1:]:
+            with tracing.span('pretrain'):
+                agent.pretrain(PRETRAIN_EPOCHS)
+            agent.epsilon = PRETRAIN_EPSILON
+    # epsilon=VALUE sets where the exploration schedule of a new run starts,
+    # a resumed run continues from its checkpoint
+    if resumed is None:
+        for arg in args[1:]:
+            if arg.startswith('epsilon='):
+                agent.epsilon = float(arg[len('epsilon='):])
     running = True
-    scores = []
-    game.step()
-    renderer.rerender()
+    episode_start = time.perf_counter()
+
+    def end_episode(decay=True):
+        # Logs the finished game and starts the next one, checkpointing if
+        # it is time to
+        nonlocal episode_start, last_checkpoint
+        metrics.log_episode(score=game.get_score(), pieces=game.get_drops(),
+                            lines=game.get_lines(),
+                            duration=time.perf_counter() - episode_start,
+                            epsilon=agent.epsilon)
+        if decay:
+            agent.decay_epsilon()
+        game.reset()
+        if (checkpoint_dir is not None
+                and time.perf_counter() - last_checkpoint >= CHECKPOINT_INTERVAL):
+            save_checkpoint()
+            last_checkpoint = time.perf_counter()
+        episode_start = time.perf_counter()
+
+    with tracing.span('step'):
+        game.step()
+    with tracing.span('render'):
+        renderer.rerender()
     current_state = game.get_board_statistics()
     steps = 0
     reset_code = False 
     reset_inner_loop_1 = False
     reset_inner_loop_2 = False
-    while running:
-        next_state = game.get_next_state()
-        best_state = agent.select_state(next_state.values())
-        best_action = None
+    # Headless runs only end with Ctrl-C, which must not skip the checkpoint
+    # at exit
+    try:
+        while running:
+            with tracing.span('get_next_state'):
+                next_state = game.get_next_state(state_cache)
+            with tracing.span('select_state'):
+                best_state = agent.select_state(next_state.values())
+            best_action = None
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+            with tracing.span('events'):
+                if viewer_mode or headless:
+                    running = renderer.is_running()
+                else:
+                    for event in pygame.event.get():
+                        if event.type == pygame.QUIT:
+                            running = False
 
-        if(game.is_over()):
-            reset_code = True
+            if(game.is_over()):
+                reset_code = True
         
-        if (reset_code == True):
-            agent.train(len(agent.memory))
-            game.reset()
+            if (reset_code == True):
+                end_episode()
             
-        elif(reset_code == False):
-            print("The best state is, ",best_state)
-            for action, state in next_state.items():
-                if state == best_state:
-                    best_action = action
-                    break
-            print("The best action is ", best_action)
-
-            while(game.get_current_piece().rotation != best_action[1]):
-                game.set_next_input(Input.C_ROTATE.value)
-                game.step()
-                renderer.rerender()
-                if(game.is_over()):
-                    reset_inner_loop_1 = True
-                    break
-            if(reset_inner_loop_1 == False):
-                while(game.get_current_piece().position[0] != best_action[0]):
-                    if(best_action[0] < game.get_current_piece().position[0]):
-                        game.set_next_input(Input.MOVE_LEFT.value)
-                    else:
-                        game.set_next_input(Input.MOVE_RIGHT.value)
-                    game.step()
-                    renderer.rerender()
-                    if(game.is_over()):
-                        reset_inner_loop_2 = True
+            elif(reset_code == False):
+                if verbose:
+                    print("The best state is, ",best_state)
+                for action, state in next_state.items():
+                    if state == best_state:
+                        best_action = action
                         break
-            if(reset_inner_loop_1 == True or reset_inner_loop_2 == True):
-                game.reset()
-            if(reset_inner_loop_1 == False and reset_inner_loop_2 == False):
-                game.set_next_input(Input.HARD_DROP.value)
-                game.step()
-                renderer.rerender()
-                reward = game.get_score()
-                done = game.is_over()
-                if(not(done)):
-                    agent.remember(current_state,next_state[best_action],reward,done)
-                    current_state = next_state[best_action]
-                    scores.append(game.get_score())
-                    #steps += 1
-                    #if(steps == 33):
-                    #    steps = 0
-                    #    
-                    game.step()
-                    renderer.rerender()
-                    #time.sleep(1)
+                if verbose:
+                    print("The best action is ", best_action)
+
+                # Shortest inputs first, the loops below finish the move if the
+                # stack got in the way
+                with tracing.span('move'):
+                    play_inputs(game, best_action[0], best_action[1], renderer)
+                while(game.get_current_piece().rotation != best_action[1]):
+                    game.set_next_input(Input.C_ROTATE.value)
+                    with tracing.span('step'):
+                        game.step()
+                    with tracing.span('render'):
+                        renderer.rerender()
                     if(game.is_over()):
-                        agent.train(len(agent.memory))
-                        game.reset()
-                else:
-                    agent.train(len(agent.memory))
-                    game.reset()
-            reset_inner_loop_1 = False
-            reset_inner_loop_2 = False
-        reset_code = False
+                        reset_inner_loop_1 = True
+                        break
+                if(reset_inner_loop_1 == False):
+                    while(game.get_current_piece().position[0] != best_action[0]):
+                        if(best_action[0] < game.get_current_piece().position[0]):
+                            game.set_next_input(Input.MOVE_LEFT.value)
+                        else:
+                            game.set_next_input(Input.MOVE_RIGHT.value)
+                        with tracing.span('step'):
+                            game.step()
+                        with tracing.span('render'):
+                            renderer.rerender()
+                        if(game.is_over()):
+                            reset_inner_loop_2 = True
+                            break
+                if(reset_inner_loop_1 == True or reset_inner_loop_2 == True):
+                    end_episode(decay=False)
+                if(reset_inner_loop_1 == False and reset_inner_loop_2 == False):
+                    game.set_next_input(Input.HARD_DROP.value)
+                    with tracing.span('step'):
+                        result = game.step()
+                    with tracing.span('render'):
+                        renderer.rerender()
+                    reward = game.get_score()
+                    done = result.game_over
+                    if(not(done)):
+                        agent.remember(current_state,next_state[best_action],reward,done)
+                        current_state = next_state[best_action]
+                        placements += 1
+                        loss = agent.observe_placement(placements)
+                        if loss is not None:
+                            metrics.log_update(
+                                    loss=loss, epsilon=agent.epsilon,
+                                    buffer_size=len(agent.memory),
+                                    updates_per_second=agent.get_updates_per_second())
+                        #steps += 1
+                        #if(steps == 33):
+                        #    steps = 0
+                        #    
+                        with tracing.span('step'):
+                            game.step()
+                        with tracing.span('render'):
+                            renderer.rerender()
+                        #time.sleep(1)
+                        if(game.is_over()):
+                            end_episode()
+                    else:
+                        end_episode()
+                reset_inner_loop_1 = False
+                reset_inner_loop_2 = False
+            reset_code = False
+    except KeyboardInterrupt:
+        print("Interrupted")
+    finally:
+        if checkpoint_dir is not None:
+            save_checkpoint()
+        metrics.close()
+        if viewer_mode:
+            renderer.close()
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv)
 
 
 
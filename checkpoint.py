@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Checkpoints for long training runs. Each checkpoint is written to a new
+numbered directory, and only once it is complete does the latest file
+switch to it (an atomic replace), so a run killed in the middle of saving
+resumes from the previous checkpoint. Older checkpoints are removed.
+'''
+
+import json
+import os
+import random
+import shutil
+import numpy as np
+
+# Checkpoints kept besides the latest one
+KEEP = 1
+
+
+def save(directory: str, write) -> str:
+    '''
+    Calls write(path) with a new empty checkpoint directory, then makes it
+    the latest checkpoint. Returns its path.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    names = _get_checkpoints(directory)
+    number = int(names[-1].split('-')[1]) + 1 if names else 0
+    name = f'checkpoint-{number:06d}'
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    write(path)
+    latest = os.path.join(directory, 'latest')
+    with open(latest + '.tmp', 'w') as file:
+        file.write(name)
+    os.replace(latest + '.tmp', latest)
+    for old in names[:max(len(names) - KEEP, 0)]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return path
+
+
+def get_latest(directory: str) -> str:
+    '''
+    Returns the path of the latest complete checkpoint, or None
+    '''
+    try:
+        with open(os.path.join(directory, 'latest')) as file:
+            return os.path.join(directory, file.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def _get_checkpoints(directory: str) -> [str]:
+    return sorted(name for name in os.listdir(directory)
+                  if name.startswith('checkpoint-'))
+
+
+def save_random_state(path: str) -> None:
+    '''
+    Saves the states of random and np.random, which draw the 7-bags,
+    exploration and minibatches
+    '''
+    version, state, gauss = random.getstate()
+    name, keys, position, has_gauss, cached_gauss = np.random.get_state()
+    with open(os.path.join(path, 'random.json'), 'w') as file:
+        json.dump({'random': [version, list(state), gauss],
+                   'numpy': [name, keys.tolist(), position, has_gauss,
+                             cached_gauss]}, file)
+
+
+def load_random_state(path: str) -> None:
+    with open(os.path.join(path, 'random.json')) as file:
+        states = json.load(file)
+    version, state, gauss = states['random']
+    random.setstate((version, tuple(state), gauss))
+    name, keys, position, has_gauss, cached_gauss = states['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), position,
+                         has_gauss, cached_gauss))
+
+
+def get_directory(args: [str], default: str) -> str:
+    '''
+    Returns DIR if the arguments contain checkpoint=DIR, the default if they
+    contain checkpoint or resume, otherwise None
+    '''
+    for arg in args:
+        if arg.startswith('checkpoint='):
+            return arg[len('checkpoint='):]
+    if 'checkpoint' in args or 'resume' in args:
+        return default
+    return None
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Streams self-play transitions to fixed-size .npz shards on disk, and reads
+them back as shuffled training batches. Data generation and training can
+therefore run on different machines and at different times.
+
+Every record holds the packed board before the move (see observation.py),
+the board statistics [score, holes, bumpiness, aggregate height] before and
+after the move, the (x, rotation) action, the score gained and whether the
+game ended. Each writer owns its shards and its own index file, so any
+number of writers can share a directory. Generate data with, for example:
+
+    python3 dataset.py generate data/ -p simple:6,1,1 -s 0-99 -m 500
+'''
+
+from tetris_game import TetrisGame
+from observation import pack_rows
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import numpy as np
+
+# Name, dtype and shape of every field of a record
+FIELDS = [
+    ('board', np.uint16, (21,)),
+    ('state', np.float32, (4,)),
+    ('afterstate', np.float32, (4,)),
+    ('action', np.int8, (2,)),
+    ('reward', np.float32, ()),
+    ('done', np.bool_, ()),
+]
+
+
+def _write_atomically(path: str, write) -> None:
+    # Readers never see a partially written file
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        write(file)
+    os.replace(temporary, path)
+
+
+class DatasetWriter:
+    '''
+    Buffers records in preallocated arrays and writes them out as a shard
+    whenever shard_size records have been added. Shards and the writer's
+    index file are replaced atomically, so readers can run at the same time.
+    '''
+
+    def __init__(self, directory: str, writer_id: str = None,
+                 shard_size: int = 100_000) -> None:
+        assert shard_size > 0
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        if writer_id is None:
+            writer_id = f'{os.getpid()}-{os.urandom(4).hex()}'
+        self.writer_id = writer_id
+        self.shard_size = shard_size
+        self.buffers = {name: np.zeros((shard_size,) + shape, dtype=dtype)
+                        for name, dtype, shape in FIELDS}
+        self.count = 0
+        self.shards = []
+
+    def add(self, board: np.ndarray, state: [float], afterstate: [float],
+            action: (int, int), reward: float, done: bool) -> None:
+        '''
+        Adds one transition. board is the 21x10 simple board, which is
+        stored packed.
+        '''
+        i = self.count
+        self.buffers['board'][i] = pack_rows(board)
+        self.buffers['state'][i] = state
+        self.buffers['afterstate'][i] = afterstate
+        self.buffers['action'][i] = action
+        self.buffers['reward'][i] = reward
+        self.buffers['done'][i] = done
+        self.count += 1
+        if self.count == self.shard_size:
+            self.flush()
+
+    def flush(self) -> None:
+        '''
+        Writes buffered records to a new shard, even if it is not full
+        '''
+        if self.count == 0:
+            return
+        name = f'shard-{self.writer_id}-{len(self.shards):05d}.npz'
+        arrays = {field: buffer[:self.count]
+                  for field, buffer in self.buffers.items()}
+        _write_atomically(os.path.join(self.directory, name),
+                          lambda file: np.savez(file, **arrays))
+        self.shards.append({'file': name, 'records': self.count})
+        index = json.dumps({'shards': self.shards}).encode()
+        _write_atomically(os.path.join(self.directory,
+                                       f'index-{self.writer_id}.json'),
+                          lambda file: file.write(index))
+        self.count = 0
+
+    def close(self) -> None:
+        self.flush()
+
+
+def read_index(directory: str) -> [dict]:
+    '''
+    Returns every shard listed by every writer in directory
+    '''
+    shards = []
+    for path in sorted(glob.glob(os.path.join(directory, 'index-*.json'))):
+        with open(path) as file:
+            shards += json.load(file)['shards']
+    return shards
+
+
+def read_batches(directory: str, batch_size: int,
+                 shards_in_memory: int = 4, epochs: int = 1,
+                 seed: int = None):
+    '''
+    Generator that yields dictionaries of arrays with batch_size records,
+    one array per field. Shards are visited in random order, and the records
+    of shards_in_memory shards at a time are shuffled together, so batches
+    mix data from different games and writers. The final incomplete batch of
+    each group of shards is dropped. Boards are yielded packed; use
+    observation.unpack_rows to expand them.
+    '''
+    rng = np.random.default_rng(seed)
+    shards = read_index(directory)
+    for _ in range(epochs):
+        order = rng.permutation(len(shards))
+        for start in range(0, len(order), shards_in_memory):
+            group = []
+            for i in order[start:start + shards_in_memory]:
+                path = os.path.join(directory, shards[i]['file'])
+                with np.load(path) as shard:
+                    group.append({name: shard[name] for name, _, _ in FIELDS})
+            records = {name: np.concatenate([shard[name] for shard in group])
+                       for name, _, _ in FIELDS}
+            permutation = rng.permutation(len(records['reward']))
+            for first in range(0, len(permutation) - batch_size + 1,
+                               batch_size):
+                batch = permutation[first:first + batch_size]
+                yield {name: array[batch] for name, array in records.items()}
+
+
+def generate(directory: str, spec: str, seeds: [int], max_pieces: int,
+             shard_size: int) -> int:
+    '''
+    Plays one headless game per seed with the policy described by spec (see
+    evaluate.make_policy) and streams its transitions to directory. Returns
+    the number of records written.
+    '''
+    from evaluate import make_policy
+    from simple_ai import move
+
+    policy = make_policy(spec)
+    writer = DatasetWriter(directory, shard_size=shard_size)
+    records = 0
+    for seed in seeds:
+        random.seed(seed)
+        np.random.seed(seed)
+        game = TetrisGame(60)
+        while not game.is_over() and game.get_drops() < max_pieces:
+            board = game.get_simple_board()
+            state = game.get_board_statistics()
+            score = game.get_score()
+            action = policy(game)
+            move(game, *action)
+            writer.add(board, state, game.get_board_statistics(), action,
+                       game.get_score() - score, game.is_over())
+            records += 1
+    writer.close()
+    return records
+
+
+def _generate(task: tuple) -> int:
+    return generate(*task)
+
+
+def main(args: [str]) -> None:
+    from evaluate import parse_seeds
+
+    parser = argparse.ArgumentParser(description='Self-play datasets')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate_parser = commands.add_parser('generate')
+    generate_parser.add_argument('directory')
+    generate_parser.add_argument('-p', '--policy', default='simple:6,1,1')
+    generate_parser.add_argument('-s', '--seeds', default='0-9',
+                                 type=parse_seeds)
+    generate_parser.add_argument('-m', '--max-pieces', default=500, type=int)
+    generate_parser.add_argument('-w', '--workers', default=os.cpu_count(),
+                                 type=int)
+    generate_parser.add_argument('--shard-size', default=100_000, type=int)
+    info_parser = commands.add_parser('info')
+    info_parser.add_argument('directory')
+    options = parser.parse_args(args[1:])
+
+    if options.command == 'generate':
+        # One writer per worker, each playing every workers-th seed
+        tasks = [(options.directory, options.policy,
+                  options.seeds[i::options.workers], options.max_pieces,
+                  options.shard_size) for i in range(options.workers)]
+        with ProcessPoolExecutor(max_workers=options.workers) as executor:
+            records = sum(executor.map(_generate, tasks))
+        print(f'Wrote {records} records')
+    else:
+        shards = read_index(options.directory)
+        records = sum(shard['records'] for shard in shards)
+        print(f'{len(shards)} shards, {records} records')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
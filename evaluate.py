@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Headless tournament between AIs. Every policy plays the same list of seeds
+without rendering, in a process pool, until game over or a piece cap. The
+results are printed (or written) as JSON.
+
+Policies are given as strings:
+
+    random                  uniformly random placement
+    simple:W1,W2,W3         simple_ai.get_next_move with the given weights
+    dqn:PATH                DQN model saved with keras at PATH
+    linear[:NAME=W,...]     simple_ai.get_next_move_linear with the given
+                            feature weights, El-Tetris weights by default
+
+Example:
+
+    python3 evaluate.py -p simple:6,1,1 -p random -s 0-99 -m 500
+'''
+
+from tetris_game import TetrisGame
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+
+PERCENTILES = [10, 25, 75, 90]
+
+# Keep pygame's banner out of the JSON on stdout, workers import it through
+# simple_ai
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+# Policies already built in this process, by spec
+_policies = {}
+
+
+def _random_policy(game: TetrisGame) -> (int, int):
+    return (random.randrange(11), random.randrange(4))
+
+
+def _make_simple_policy(w_1: int, w_2: int, w_3: int):
+    import simple_ai
+
+    def policy(game: TetrisGame) -> (int, int):
+        return simple_ai.get_next_move(game, w_1, w_2, w_3)
+    return policy
+
+
+def _make_linear_policy(argument: str):
+    import simple_ai
+    from features import LinearEvaluator, EL_TETRIS_WEIGHTS
+
+    weights = EL_TETRIS_WEIGHTS
+    if argument:
+        weights = {name: float(weight) for name, weight in
+                   (part.split('=') for part in argument.split(','))}
+    evaluator = LinearEvaluator(weights)
+
+    def policy(game: TetrisGame) -> (int, int):
+        return simple_ai.get_next_move_linear(game, evaluator)
+    return policy
+
+
+def _make_dqn_policy(path: str):
+    from agent import DQNAgent
+    from keras.models import load_model
+
+    agent = DQNAgent(4, 5)
+    agent.model = load_model(path)
+    agent.epsilon = 0.0
+
+    def policy(game: TetrisGame) -> (int, int):
+        states = game.get_next_state()
+        best_state = agent.select_state(states.values())
+        for action, state in states.items():
+            if state == best_state:
+                return action
+    return policy
+
+
+def make_policy(spec: str):
+    '''
+    Returns a function from a game to the (x, rotation) placement chosen by
+    the policy described by spec. Policies are built once per process.
+    '''
+    if spec not in _policies:
+        kind, _, argument = spec.partition(':')
+        match kind:
+            case 'random':
+                _policies[spec] = _random_policy
+            case 'simple':
+                weights = [int(w) for w in argument.split(',')]
+                _policies[spec] = _make_simple_policy(*weights)
+            case 'dqn':
+                _policies[spec] = _make_dqn_policy(argument)
+            case 'linear':
+                _policies[spec] = _make_linear_policy(argument)
+            case _:
+                raise ValueError(f'Unknown policy: {spec}')
+    return _policies[spec]
+
+
+def play_game(spec: str, seed: int, max_pieces: int) -> dict:
+    '''
+    Plays one headless game with the given policy and seed until game over or
+    until max_pieces pieces have been dropped. Returns the game's results.
+    '''
+    # Imported here so worker processes only pay for what they use
+    from simple_ai import move
+
+    policy = make_policy(spec)
+    random.seed(seed)
+    np.random.seed(seed)
+    game = TetrisGame(60)
+    decisions = 0
+    decision_time = 0.0
+    start = time.perf_counter()
+    while not game.is_over() and game.get_drops() < max_pieces:
+        decision_start = time.perf_counter()
+        position, rotation = policy(game)
+        decision_time += time.perf_counter() - decision_start
+        decisions += 1
+        move(game, position, rotation)
+    return {
+        'policy': spec,
+        'seed': seed,
+        'score': game.get_score(),
+        'lines': game.get_lines(),
+        'pieces': game.get_drops(),
+        'game_over': game.is_over(),
+        'decisions': decisions,
+        'decision_time': decision_time,
+        'duration': time.perf_counter() - start,
+    }
+
+
+def _play_game(task: tuple) -> dict:
+    return play_game(*task)
+
+
+def summarize(values: [float]) -> dict:
+    '''
+    Returns the mean, median, extremes and percentiles of values
+    '''
+    values = np.array(values, dtype=float)
+    summary = {
+        'mean': float(np.mean(values)),
+        'median': float(np.median(values)),
+        'min': float(np.min(values)),
+        'max': float(np.max(values)),
+    }
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}'] = float(np.percentile(values, percentile))
+    return summary
+
+
+def run_tournament(specs: [str], seeds: [int], max_pieces: int = 500,
+                   workers: int = None) -> dict:
+    '''
+    Plays every policy on every seed in a process pool and returns a report
+    with per-policy summaries and the individual games.
+    '''
+    tasks = [(spec, seed, max_pieces) for spec in specs for seed in seeds]
+    if workers == 1:
+        games = [_play_game(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            games = list(executor.map(_play_game, tasks))
+
+    policies = {}
+    for spec in specs:
+        results = [game for game in games if game['policy'] == spec]
+        decisions = sum(game['decisions'] for game in results)
+        decision_time = sum(game['decision_time'] for game in results)
+        policies[spec] = {
+            'games': len(results),
+            'score': summarize([game['score'] for game in results]),
+            'lines': summarize([game['lines'] for game in results]),
+            'pieces': summarize([game['pieces'] for game in results]),
+            'decisions_per_second': (decisions / decision_time
+                                     if decision_time > 0 else None),
+        }
+    return {
+        'seeds': seeds,
+        'max_pieces': max_pieces,
+        'policies': policies,
+        'games': games,
+    }
+
+
+def parse_seeds(text: str) -> [int]:
+    '''
+    Parses a seed list such as "0-99" or "1,2,5-7"
+    '''
+    seeds = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            seeds += range(int(first), int(last) + 1)
+        else:
+            seeds.append(int(part))
+    return seeds
+
+
+def run_benchmark(specs: [str], seeds: [int], max_pieces: int = 200,
+                  frames: int = 20_000) -> dict:
+    '''
+    Measures, in this process, how fast a fresh interpreter imports this
+    module and simple_ai, how many frames per second the engine steps with
+    random inputs, and the pieces and decisions per second of each policy
+    '''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import evaluate, simple_ai'],
+                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                   check=True)
+    startup = time.perf_counter() - start
+
+    random.seed(0)
+    game = TetrisGame(60)
+    start = time.perf_counter()
+    for _ in range(frames):
+        if game.is_over():
+            game.reset()
+        game.set_next_input(random.randrange(8))
+        game.step()
+    frames_per_second = frames / (time.perf_counter() - start)
+
+    policies = {}
+    for spec in specs:
+        games = [play_game(spec, seed, max_pieces) for seed in seeds]
+        duration = sum(game['duration'] for game in games)
+        decision_time = sum(game['decision_time'] for game in games)
+        policies[spec] = {
+            'pieces_per_second': sum(game['pieces'] for game in games)
+            / duration,
+            'decisions_per_second': sum(game['decisions'] for game in games)
+            / decision_time if decision_time > 0 else None,
+        }
+    return {
+        'startup_seconds': startup,
+        'engine_frames_per_second': frames_per_second,
+        'policies': policies,
+    }
+
+
+def bench_main(args: [str]) -> None:
+    parser = argparse.ArgumentParser(description='Speed benchmark')
+    parser.add_argument('-p', '--policy', action='append',
+                        help='policy to time, may be repeated (default: '
+                        'random, linear and simple:6,1,1)')
+    parser.add_argument('-s', '--seeds', default='0-2', type=parse_seeds,
+                        help='seeds to play, such as 0-99 or 1,2,5-7')
+    parser.add_argument('-m', '--max-pieces', default=200, type=int,
+                        help='stop each game after this many pieces')
+    options = parser.parse_args(args[1:])
+    specs = options.policy or ['random', 'linear', 'simple:6,1,1']
+    report = run_benchmark(specs, options.seeds, options.max_pieces)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+def main(args: [str]) -> None:
+    parser = argparse.ArgumentParser(description='Headless AI tournament')
+    parser.add_argument('-p', '--policy', action='append', required=True,
+                        help='policy to evaluate, may be repeated')
+    parser.add_argument('-s', '--seeds', default='0-9', type=parse_seeds,
+                        help='seeds to play, such as 0-99 or 1,2,5-7')
+    parser.add_argument('-m', '--max-pieces', default=500, type=int,
+                        help='stop each game after this many pieces')
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int,
+                        help='number of worker processes')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the JSON report here instead of stdout')
+    options = parser.parse_args(args[1:])
+
+    report = run_tournament(options.policy, options.seeds,
+                            options.max_pieces, options.workers)
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
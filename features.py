@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Board features for linear evaluators. All features of a board, or of a
+batch of boards, are computed together with array operations, so adding
+features to an evaluator barely changes its cost. Placements are dropped
+analytically and scored in one batch as well.
+'''
+
+from tetris_game import piece_cells, clamp_position, get_column_stats
+import numpy as np
+
+# Features of a board, in the order they appear in feature vectors
+BOARD_FEATURES = [
+    'holes',               # empty cells right below a filled cell
+    'bumpiness',           # sum of height differences of adjacent columns
+    'aggregate_height',    # sum of column heights
+    'max_height',          # height of the tallest column
+    'wells',               # sum of 1 + 2 + ... + depth over all wells
+    'row_transitions',     # filled/empty changes along non-empty rows
+    'column_transitions',  # filled/empty changes down columns
+    'hole_depth',          # filled cells above each hole, summed
+]
+# Features of a placement, which depend on the piece as well as the board
+PLACEMENT_FEATURES = [
+    'landing_height',      # mean height of the piece's cells when it lands
+    'eroded_cells',        # lines cleared times piece cells cleared
+    'line_score',          # simple_ai.line_scores of the lines cleared
+]
+FEATURES = BOARD_FEATURES + PLACEMENT_FEATURES
+
+# Weights from the El-Tetris evaluator (Islam, 2009) for the features it
+# shares with this module
+EL_TETRIS_WEIGHTS = {
+    'landing_height': -4.500158825082766,
+    'eroded_cells': 3.4181268101392694,
+    'row_transitions': -3.2178882868487753,
+    'column_transitions': -9.348695305445199,
+    'holes': -7.899265427351652,
+    'wells': -3.3855972247263626,
+}
+
+_line_scores = np.array([0, 1, 3, 5, 8])
+
+
+def get_board_features(boards: np.ndarray) -> np.ndarray:
+    '''
+    Returns the BOARD_FEATURES of a board or a batch of boards as float
+    vectors. The last two axes are the rows and the 10 columns. 40-row
+    boards are cut to the 21 visible rows, like get_simple_board.
+    '''
+    filled = np.asarray(boards) != 0
+    if filled.shape[-2] == 40:
+        filled = filled[..., 19:, :]
+    rows = filled.shape[-2]
+    heights, holes, bumpiness = get_column_stats(filled)
+    tops = rows - heights
+
+    # Filled cells in each row and above, to weigh holes by how buried they
+    # are
+    above = np.cumsum(filled, axis=-2)
+    hole_depth = (above[..., :-1, :] * holes).sum(axis=(-2, -1))
+
+    # Walls count as filled for wells and row transitions
+    walled = np.pad(filled, [(0, 0)] * (filled.ndim - 1) + [(1, 1)],
+                    constant_values=True)
+    row_changes = (walled[..., 1:] != walled[..., :-1]).sum(axis=-1)
+    row_transitions = (row_changes * filled.any(axis=-1)).sum(axis=-1)
+    # The floor counts as filled for column transitions
+    floor = np.ones(filled.shape[:-2] + (1, 10), dtype=bool)
+    floored = np.concatenate([filled, floor], axis=-2)
+    column_transitions = (floored[..., 1:, :]
+                          != floored[..., :-1, :]).sum(axis=(-2, -1))
+
+    # Open cells above the column top with both sides filled are well cells.
+    # A well cell at depth d adds d, so a well of depth n adds 1 + ... + n.
+    row_index = np.arange(rows)[:, None]
+    well_cells = (walled[..., :-2] & walled[..., 2:]
+                  & (row_index < tops[..., None, :]))
+    depth = np.zeros(filled.shape[:-2] + (10,), dtype=int)
+    wells = np.zeros(filled.shape[:-2], dtype=int)
+    for i in range(rows):
+        depth = (depth + 1) * well_cells[..., i, :]
+        wells = wells + depth.sum(axis=-1)
+
+    return np.stack([
+        holes.sum(axis=(-2, -1)),
+        bumpiness,
+        heights.sum(axis=-1),
+        heights.max(axis=-1),
+        wells,
+        row_transitions,
+        column_transitions,
+        hole_depth,
+    ], axis=-1).astype(float)
+
+
+def get_placement_features(board: np.ndarray, kind: int,
+                           placements: [(int, int)],
+                           start_y: int = 19) -> (np.ndarray, np.ndarray):
+    '''
+    Drops a piece of the given kind from row start_y at every (x, rotation)
+    placement of a 40x10 board, clears full lines and returns the FEATURES
+    of each result, plus a mask of the placements that are possible. Like
+    simple_ai.estimate_utility, x is clamped against the walls and the piece
+    goes straight down, so kicks and moves under overhangs are not found.
+    '''
+    filled = np.asarray(board) != 0
+    cells = []
+    for x, rotation in placements:
+        x = clamp_position(kind, rotation, x)
+        cells.append(piece_cells[kind][rotation] + np.array([x, start_y]))
+    cells = np.array(cells)
+    xs = cells[..., 0]
+    ys = cells[..., 1]
+
+    # First filled row of every column, ignoring anything above the piece
+    top = max(ys.min(), 0)
+    below = filled.copy()
+    below[:top] = False
+    tops = np.where(below.any(axis=0), below.argmax(axis=0), 40)
+    distance = (tops[xs] - 1 - ys).min(axis=-1)
+    valid = (distance >= 0) & (ys.min(axis=-1) >= 0)
+    ys = ys + np.maximum(distance, 0)[:, None]
+    ys = np.clip(ys, 0, 39)
+
+    count = len(placements)
+    index = np.arange(count)[:, None]
+    piece = np.zeros((count, 40, 10), dtype=bool)
+    piece[index, ys, xs] = True
+    boards = piece | filled
+
+    full = boards.all(axis=-1)
+    lines = full.sum(axis=-1)
+    eroded_cells = lines * (piece & full[..., None]).sum(axis=(-2, -1))
+    # Full rows sort to the top and are emptied, the rest keep their order
+    order = np.argsort(~full, axis=-1, kind='stable')
+    boards = boards[index, order]
+    boards[np.arange(40) < lines[:, None]] = False
+
+    features = np.concatenate([
+        get_board_features(boards),
+        np.stack([(40 - ys).mean(axis=-1), eroded_cells,
+                  _line_scores[np.minimum(lines, 4)]], axis=-1),
+    ], axis=-1)
+    return features, valid
+
+
+class LinearEvaluator:
+    '''
+    Scores feature vectors with a dot product. Weights are given by feature
+    name, and features without a weight are ignored.
+    '''
+
+    def __init__(self, weights: dict) -> None:
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError(f'Unknown features: {sorted(unknown)}')
+        self.weights = np.array([weights.get(name, 0.0)
+                                 for name in FEATURES])
+
+    def get_weights(self) -> dict:
+        return {name: float(weight)
+                for name, weight in zip(FEATURES, self.weights)
+                if weight != 0}
+
+    def evaluate(self, features: np.ndarray) -> np.ndarray:
+        '''
+        Returns the value of one feature vector or of each in a batch
+        '''
+        return features @ self.weights
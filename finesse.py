@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Shortest input sequences for reaching placements. Only one input registers
+per frame, so a placement takes at least as many frames as rotations plus
+moves. The table holds, for every piece kind, target rotation and target x,
+the fewest inputs that bring a freshly spawned piece there on an empty
+board, such as one counter clockwise rotation instead of three clockwise
+ones. play_inputs checks the piece after every frame, so callers can fall
+back to step-by-step moves when the stack gets in the way.
+
+Running this file verifies the whole table against TetrisGame.
+'''
+
+from tetris_game import (TetrisGame, Input, Piece, piece_cells, rotate_piece,
+                         rotation_cache)
+from collections import deque
+import sys
+import tracing
+import numpy as np
+
+SPAWN_X = 5
+SPAWN_Y = 19
+
+# Inputs in the order they are tried. Rotations come first, so among
+# sequences of equal length the ones that rotate before moving are found.
+_inputs = [Input.C_ROTATE.value, Input.CC_ROTATE.value,
+           Input.MOVE_LEFT.value, Input.MOVE_RIGHT.value]
+_empty_board = np.zeros((40, 10), dtype=int)
+
+
+def _get_next_pose(kind: int, pose: (int, int), next_input: int) -> (int, int):
+    # Pose (x, rotation) after an input on an empty board, None if it fails
+    x, rotation = pose
+    if next_input in (Input.MOVE_LEFT.value, Input.MOVE_RIGHT.value):
+        x += 1 if next_input == Input.MOVE_RIGHT.value else -1
+        xs = piece_cells[kind][rotation][:, 0] + x
+        return (x, rotation) if xs.min() >= 0 and xs.max() < 10 else None
+    piece = Piece(kind, np.array([x, SPAWN_Y]), rotation)
+    piece = rotate_piece(_empty_board, piece,
+                         next_input == Input.C_ROTATE.value, rotation_cache)
+    return None if piece is None else (int(piece.position[0]), piece.rotation)
+
+
+def _search(kind: int, start: (int, int)) -> dict:
+    # Breadth first search over poses, returns the shortest input sequence
+    # to every reachable pose
+    paths = {start: []}
+    queue = deque([start])
+    while queue:
+        pose = queue.popleft()
+        for next_input in _inputs:
+            next_pose = _get_next_pose(kind, pose, next_input)
+            if next_pose is not None and next_pose not in paths:
+                paths[next_pose] = paths[pose] + [next_input]
+                queue.append(next_pose)
+    return paths
+
+
+def _get_table(kind: int, start: (int, int)) -> [[[int]]]:
+    # Targets x are 0 to 10 like in simple_ai. Unreachable ones map to the
+    # nearest reachable x, where moving toward them stops at the wall.
+    paths = _search(kind, start)
+    table = []
+    for rotation in range(4):
+        reachable = sorted(x for x, r in paths if r == rotation)
+        row = []
+        for x in range(11):
+            nearest = min(reachable, key=lambda r: (abs(r - x), r))
+            row.append(((nearest, rotation), paths[(nearest, rotation)]))
+        table.append(row)
+    return table
+
+
+# finesse_table[kind][rotation][x] is the target pose (x, rotation) and the
+# shortest list of Input values reaching it from the spawn pose
+finesse_table = [_get_table(kind, (SPAWN_X, 0)) for kind in range(7)]
+
+# Tables from other starting poses, built when first needed
+_tables = {}
+
+
+def get_inputs(kind: int, x: int, rotation: int,
+               start: (int, int) = (SPAWN_X, 0)) -> ((int, int), [int]):
+    '''
+    Returns the pose a piece ends in when aiming for (x, rotation) from the
+    start pose, and the shortest list of inputs getting it there
+    '''
+    if start == (SPAWN_X, 0):
+        return finesse_table[kind][rotation][x]
+    if (kind, start) not in _tables:
+        _tables[(kind, start)] = _get_table(kind, start)
+    return _tables[(kind, start)][rotation][x]
+
+
+def play_inputs(game: TetrisGame, x: int, rotation: int, renderer=None,
+                clock=None) -> bool:
+    '''
+    Plays the shortest inputs toward (x, rotation), one per frame, without
+    dropping the piece. Stops as soon as the piece is not where the table
+    expects it, which happens when the stack blocks a move or a kick, or
+    the piece locks. Returns whether the whole sequence went as planned.
+    '''
+    piece = game.get_current_piece()
+    start = (int(piece.position[0]), piece.rotation)
+    if not 0 <= x <= 10:
+        return False
+    pose = start
+    _, inputs = get_inputs(piece.kind, x, rotation, start)
+    drops = game.get_drops()
+    for next_input in inputs:
+        pose = _get_next_pose(piece.kind, pose, next_input)
+        game.set_next_input(next_input)
+        with tracing.span('step'):
+            game.step()
+        if renderer is not None:
+            with tracing.span('render'):
+                renderer.rerender()
+            if clock is not None:
+                with tracing.span('clock.tick'):
+                    clock.tick(game.get_frame_rate())
+        piece = game.get_current_piece()
+        if (game.is_over() or game.get_drops() != drops
+                or (int(piece.position[0]), piece.rotation) != pose):
+            return False
+    return True
+
+
+def verify_table() -> (int, int):
+    '''
+    Plays every entry of finesse_table in a fresh TetrisGame and checks that
+    the piece ends in the expected pose. Returns the number of entries and
+    the total number of inputs, and raises AssertionError on a mismatch.
+    '''
+    entries = 0
+    frames = 0
+    for kind in range(7):
+        for rotation in range(4):
+            for x in range(11):
+                game = TetrisGame(60)
+                game.piece = Piece(kind, np.array([SPAWN_X, SPAWN_Y]), 0)
+                target, inputs = finesse_table[kind][rotation][x]
+                assert play_inputs(game, x, rotation), (kind, rotation, x)
+                piece = game.get_current_piece()
+                assert (int(piece.position[0]), piece.rotation) == target
+                entries += 1
+                frames += len(inputs)
+    return entries, frames
+
+
+def main(args: [str]) -> None:
+    entries, frames = verify_table()
+    print(f'{entries} placements verified, '
+          f'{frames / entries:.2f} inputs per placement on average')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
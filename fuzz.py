@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Differential fuzzing of game engines against TetrisGame. A seeded program of
+random inputs, idle stretches and placements is played on the reference
+engine and on a candidate side by side, and their full states are compared
+after every action. A divergence is shrunk to a minimal program that still
+diverges and saved as JSON for replaying.
+
+Candidates are classes with TetrisGame's constructor, step, set_next_input,
+reset and getters, plus the rule state attributes compared in get_state.
+If they have step_n it is used for idle stretches. Without a candidate, the
+reference is compared with itself fast-forwarding idle frames with step_n.
+
+    python3 fuzz.py run -c fast_engine:FastGame -s 0-99 -n 100000
+    python3 fuzz.py replay repro.json -c fast_engine:FastGame
+'''
+
+from tetris_game import (TetrisGame, Input, Piece, StepResult, piece_cells,
+                         clamp_position, get_column_stats)
+from features import (LinearEvaluator, EL_TETRIS_WEIGHTS,
+                      get_placement_features)
+from finesse import get_inputs
+from evaluate import parse_seeds
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import copy
+import importlib
+import json
+import os
+import random
+import sys
+import time
+import numpy as np
+
+# Input value of the action that resets both games
+RESET = -1
+
+# Attributes holding rule state that getters do not expose
+RULE_STATE = ['waited_frames', 'lock_mode', 'lock_count', 'can_hold',
+              'soft_drop_mode', 'successful_rotation', 'had_tetris',
+              'next_input']
+
+# Rules counted on the reference during a run, so the summary shows which
+# ones a run never reached
+COVERAGE = ['single', 'double', 'triple', 'tetris', 'back_to_back',
+            't_spin', 't_spin_single', 't_spin_double', 't_spin_triple',
+            'level_up', 'game_over']
+_line_names = [None, 'single', 'double', 'triple', 'tetris']
+
+# Placements alternate between phases of this many pieces: stacking around an
+# open well for tetrises and T-spins, which starts every game as random play
+# rarely lasts long enough, and mixed random programs
+PHASE_PIECES = 40
+
+_evaluator = LinearEvaluator(EL_TETRIS_WEIGHTS)
+# Stacking must not leave holes, or rows never fill up to the well
+_stacking_evaluator = LinearEvaluator({'holes': -30, 'hole_depth': -3,
+                                       'bumpiness': -2,
+                                       'aggregate_height': -0.5,
+                                       'landing_height': -1})
+_I = 0
+_T = 6
+
+
+def load_engine(spec: str):
+    '''
+    Returns the class named by "module:Class"
+    '''
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def get_state(game) -> dict:
+    '''
+    Returns everything about a game that the rules depend on
+    '''
+    piece = game.get_current_piece()
+    state = {
+        'board': game.get_board().copy(),
+        'piece': (piece.kind, int(piece.position[0]),
+                  int(piece.position[1]), piece.rotation),
+        'next_pieces': list(game.get_next_pieces()),
+        'hold_piece': game.get_hold_piece(),
+        'score': game.get_score(),
+        'level': game.get_level(),
+        'lines': game.get_lines(),
+        'drops': game.get_drops(),
+        'is_over': game.is_over(),
+    }
+    for name in RULE_STATE:
+        state[name] = getattr(game, name)
+    return state
+
+
+def _get_result(result: StepResult) -> tuple:
+    heights = result.column_heights
+    return (result.locked, result.lines_cleared, result.t_spin,
+            result.score_delta, result.level_up, result.game_over,
+            None if heights is None else heights.tolist())
+
+
+class _Side:
+    # One engine with its own copy of the global random state, which draws
+    # the 7-bags, so two engines can run interleaved on the same seed
+    def __init__(self, engine, seed: int, fast: bool,
+                 coverage: Counter = None) -> None:
+        random.seed(seed)
+        self.game = engine(60)
+        self.fast = fast
+        self.coverage = coverage
+        self.random_state = random.getstate()
+
+    def _step(self) -> StepResult:
+        had_tetris = self.game.had_tetris
+        result = self.game.step()
+        if self.coverage is not None:
+            _count(self.coverage, result, had_tetris)
+        return result
+
+    def play(self, action: (int, int)):
+        random.setstate(self.random_state)
+        next_input, frames = action
+        if next_input == RESET:
+            self.game.reset()
+            outcome = None
+        elif frames == 1:
+            self.game.set_next_input(next_input)
+            outcome = _get_result(self._step())
+        elif self.fast and hasattr(self.game, 'step_n'):
+            self.game.set_next_input(next_input)
+            outcome = self.game.step_n(frames)
+        else:
+            self.game.set_next_input(next_input)
+            outcome = 0
+            while outcome < frames and not self.game.is_over():
+                self._step()
+                outcome += 1
+        self.random_state = random.getstate()
+        return outcome
+
+
+def _count(coverage: Counter, result: StepResult, had_tetris: bool) -> None:
+    lines = result.lines_cleared
+    if result.t_spin:
+        coverage['t_spin_' + _line_names[lines] if lines else 't_spin'] += 1
+    elif lines:
+        coverage[_line_names[lines]] += 1
+    if lines == 4 and had_tetris:
+        coverage['back_to_back'] += 1
+    if result.level_up:
+        coverage['level_up'] += 1
+    if result.game_over and result.locked:
+        coverage['game_over'] += 1
+
+
+def _get_well(game: TetrisGame) -> (int, int, int):
+    # The column stacking keeps open, the left one in every other stacking
+    # phase and the right one otherwise, how many rows at its bottom are
+    # full apart from it, and how far it is below its neighbors
+    board = game.get_board()
+    well = 9 * (game.get_drops() // (2 * PHASE_PIECES) % 2)
+    heights, _, _ = get_column_stats(board[19:] != 0)
+    full = 0
+    for row in board[39 - heights[well]::-1]:
+        if row[well] != 0 or np.count_nonzero(row) < 9:
+            break
+        full += 1
+    neighbors = heights[max(well - 1, 0):well + 2]
+    depth = int(np.delete(neighbors, min(well, 1)).min() - heights[well])
+    return well, full, depth
+
+
+def _get_spin(game: TetrisGame, rng: random.Random) -> (int, int):
+    # A T placement reached by rotating last and dropping straight down into
+    # a pose with three of the four corners around its center occupied, which
+    # the rules count as a T-spin. Line clears are preferred, spins without
+    # lines are only taken some of the time.
+    board = game.get_board() != 0
+    _, holes, _ = get_column_stats(board)
+    holes = np.count_nonzero(holes)
+    best = None
+    best_lines = 0 if rng.random() < 0.3 else 1
+    for rotation in range(4):
+        for x in range(10):
+            if (clamp_position(_T, rotation, x) != x
+                    or clamp_position(_T, (rotation - 1) % 4, x) != x):
+                continue
+            piece = Piece(_T, np.array([x, 19]), rotation)
+            distance = game.get_drop_distance(piece)
+            if distance < 0:
+                continue
+            center = piece.position + np.array([-1, -1 + distance])
+            corners = 0
+            for dx in (-1, 1):
+                for dy in (-1, 1):
+                    cx, cy = center[0] + dx, center[1] + dy
+                    corners += (not (0 <= cx < 10 and 0 <= cy < 40)
+                                or board[cy, cx])
+            if corners < 3:
+                continue
+            cells = piece_cells[_T][rotation] + piece.position
+            cells[:, 1] += distance
+            filled = board.copy()
+            filled[cells[:, 1], cells[:, 0]] = True
+            lines = int(filled.all(axis=1).sum())
+            # Spins against a wall or onto a ledge can bury cells
+            _, new_holes, _ = get_column_stats(filled)
+            if np.count_nonzero(new_holes) > holes:
+                continue
+            if lines >= best_lines:
+                best = (x, rotation)
+                best_lines = lines + 1
+    return best
+
+
+def _get_stacking_placement(game: TetrisGame,
+                            rng: random.Random) -> ((int, int), bool):
+    # Builds a stack around an open well: I pieces go upright into it once
+    # its bottom four rows are full apart from it, for tetrises and
+    # back-to-back tetrises, or to flush it once the stack has grown six rows
+    # above it regardless. T pieces take T-spins half of the time, the wall
+    # well making three occupied corners easy, and everything else avoids
+    # holes among the placements that leave the well open. Returns the
+    # placement and whether it must be reached by a final rotation.
+    piece = game.get_current_piece()
+    board = game.get_board()
+    well, full, depth = _get_well(game)
+    if piece.kind == _I and (full >= 4 or depth >= 6):
+        return (well, 1), False
+    if piece.kind == _T and rng.random() < 0.5:
+        spin = _get_spin(game, rng)
+        if spin is not None:
+            return spin, True
+    placements = [(x, rotation) for x in range(11) for rotation in range(4)]
+    features, valid = get_placement_features(board, piece.kind, placements,
+                                             piece.position[1])
+    values = np.where(valid, _stacking_evaluator.evaluate(features), -np.inf)
+    for i, (x, rotation) in enumerate(placements):
+        x = clamp_position(piece.kind, rotation, x)
+        if well in piece_cells[piece.kind][rotation][:, 0] + x:
+            values[i] -= 1e6
+    return placements[int(np.argmax(values))], False
+
+
+def _next_actions(game: TetrisGame, rng: random.Random) -> [(int, int)]:
+    # A random stretch of program. Placements are chosen by the El-Tetris
+    # evaluator half of the time, so games last long enough to clear lines
+    # and level up. Every other phase of PHASE_PIECES pieces, starting with
+    # the first, mostly stacks for tetrises and T-spins instead.
+    if game.is_over():
+        return [(RESET, 1)]
+    piece = game.get_current_piece()
+    start = (int(piece.position[0]), piece.rotation)
+    if not game.get_drops() // PHASE_PIECES % 2 and rng.random() < 0.9:
+        (x, rotation), spin = _get_stacking_placement(game, rng)
+        if spin:
+            _, inputs = get_inputs(piece.kind, x, (rotation - 1) % 4, start)
+            inputs.append(Input.C_ROTATE.value)
+        else:
+            _, inputs = get_inputs(piece.kind, x, rotation, start)
+        return [(next_input, 1)
+                for next_input in inputs + [Input.HARD_DROP.value]]
+    choice = rng.random()
+    if choice < 0.3:
+        return [(rng.randrange(len(Input)), 1)]
+    if choice < 0.45:
+        # Long enough to run into gravity and lock delay
+        return [(Input.NONE.value, rng.choice([1, 2, 5, 30, 61, 200]))]
+    if choice < 0.55:
+        # Spin at the bottom to use up the 15 lock delay resets
+        inputs = [Input.SOFT_DROP.value, Input.NONE.value]
+        inputs += [rng.choice([Input.C_ROTATE.value, Input.CC_ROTATE.value,
+                               Input.MOVE_LEFT.value,
+                               Input.MOVE_RIGHT.value])
+                   for _ in range(rng.randrange(5, 25))]
+        return [(next_input, rng.choice([1, 1, 20]))
+                for next_input in inputs]
+    if rng.random() < 0.5:
+        placements = [(x, rotation) for x in range(11)
+                      for rotation in range(4)]
+        features, valid = get_placement_features(
+                game.get_board(), piece.kind, placements, piece.position[1])
+        values = np.where(valid, _evaluator.evaluate(features), -np.inf)
+        x, rotation = placements[int(np.argmax(values))]
+    else:
+        x, rotation = rng.randrange(11), rng.randrange(4)
+    _, inputs = get_inputs(piece.kind, x, rotation, start)
+    return [(next_input, 1)
+            for next_input in inputs + [Input.HARD_DROP.value]]
+
+
+def compare(engine, seed: int, actions: [(int, int)]) -> dict:
+    '''
+    Plays a program on the reference and the candidate and returns the first
+    divergence (action index and differing fields), or None if there is none
+    '''
+    reference = _Side(TetrisGame, seed, False)
+    candidate = _Side(engine, seed, True)
+    return _play(reference, candidate, actions)
+
+
+def _play(reference: _Side, candidate: _Side, actions: [(int, int)]) -> dict:
+    for i, action in enumerate(actions):
+        expected = reference.play(action)
+        actual = candidate.play(action)
+        fields = _diff(reference.game, candidate.game, expected, actual)
+        if fields:
+            return {'action': i, 'fields': fields}
+    return None
+
+
+def _diff(reference, candidate, expected, actual) -> [str]:
+    fields = []
+    if expected != actual:
+        fields.append('result')
+    expected_state = get_state(reference)
+    actual_state = get_state(candidate)
+    fields += [name for name in expected_state
+               if not np.array_equal(expected_state[name], actual_state[name])]
+    return fields
+
+
+def fuzz(engine_spec: str, seed: int, frames: int) -> dict:
+    '''
+    Generates and plays a random program of about frames frames with the
+    given seed. Returns the number of actions and frames played, how often
+    each of the COVERAGE rules came up and, if the engines diverged, the
+    index of the action after which they did and the shrunk program
+    reproducing it.
+    '''
+    engine = load_engine(engine_spec)
+    rng = random.Random(seed)
+    coverage = Counter()
+    reference = _Side(TetrisGame, seed, False, coverage)
+    candidate = _Side(engine, seed, True)
+    actions = []
+    played = 0
+    while played < frames:
+        for action in _next_actions(reference.game, rng):
+            actions.append(action)
+            expected = reference.play(action)
+            actual = candidate.play(action)
+            played += action[1]
+            fields = _diff(reference.game, candidate.game, expected, actual)
+            if fields:
+                shrunk = shrink(engine, seed, actions)
+                return {'seed': seed, 'candidate': engine_spec,
+                        'actions': len(actions), 'frames': played,
+                        'coverage': dict(coverage),
+                        'divergence': len(actions) - 1, 'fields': fields,
+                        'repro': shrunk}
+    return {'seed': seed, 'candidate': engine_spec, 'actions': len(actions),
+            'frames': played, 'coverage': dict(coverage), 'divergence': None,
+            'fields': None, 'repro': None}
+
+
+def shrink(engine, seed: int, actions: [(int, int)],
+           max_tests: int = 2000, max_seconds: float = 60.0) -> [(int, int)]:
+    '''
+    Returns a smaller program that still diverges: chunks of actions are
+    removed while it keeps diverging (delta debugging), then idle stretches
+    are shortened and inputs replaced with NONE where possible. Both engines
+    are checkpointed after the part of the program that a test leaves alone,
+    so only the rest is replayed. Gives up after max_tests replays or
+    max_seconds seconds, as programs that stack for tetrises are long. If the
+    program does not diverge when replayed from the start, for example
+    because the candidate keeps global state, it is returned unchanged.
+    '''
+    tests = 0
+    deadline = time.monotonic() + max_seconds
+
+    def exhausted():
+        return tests >= max_tests or time.monotonic() >= deadline
+
+    def start():
+        return (_Side(TetrisGame, seed, False), _Side(engine, seed, True))
+
+    def test(checkpoint, program, i):
+        # Returns program cut after its first divergence, None if it has
+        # none. checkpoint is the state after program[:i].
+        nonlocal tests
+        tests += 1
+        reference, candidate = copy.deepcopy(checkpoint)
+        divergence = _play(reference, candidate, program[i:])
+        if divergence is not None:
+            return program[:i + divergence['action'] + 1]
+
+    program = test(start(), actions, 0)
+    if program is None:
+        return actions
+    actions = program
+    chunk = len(actions) // 2
+    while chunk >= 1 and not exhausted():
+        i = 0
+        checkpoint = start()
+        while i < len(actions) and not exhausted():
+            program = test(checkpoint, actions[:i] + actions[i + chunk:], i)
+            if program:
+                actions = program
+            else:
+                _play(*checkpoint, actions[i:i + chunk])
+                i += chunk
+        chunk = min(chunk // 2, len(actions) // 2)
+
+    checkpoint = start()
+    for i in range(len(actions)):
+        next_input, frames = actions[i]
+        while frames > 1 and not exhausted():
+            program = test(checkpoint, actions[:i]
+                           + [(next_input, frames // 2)] + actions[i + 1:], i)
+            if program is None or len(program) < len(actions):
+                break
+            actions = program
+            frames //= 2
+        if (next_input not in (RESET, Input.NONE.value)
+                and not exhausted()):
+            program = test(checkpoint, actions[:i] + [(Input.NONE.value,
+                                                       frames)]
+                           + actions[i + 1:], i)
+            if program is not None and len(program) == len(actions):
+                actions = program
+        _play(*checkpoint, actions[i:i + 1])
+    return actions
+
+
+def _fuzz(task: tuple) -> dict:
+    return fuzz(*task)
+
+
+def main(args: [str]) -> None:
+    parser = argparse.ArgumentParser(description='Differential engine fuzzer')
+    parser.add_argument('command', choices=['run', 'replay'])
+    parser.add_argument('file', nargs='?',
+                        help='reproducer to replay, or to write on failure')
+    parser.add_argument('-c', '--candidate', default='tetris_game:TetrisGame',
+                        help='engine to test, as module:Class')
+    parser.add_argument('-s', '--seeds', default='0-9', type=parse_seeds,
+                        help='seeds to run, such as 0-99 or 1,2,5-7')
+    parser.add_argument('-n', '--frames', default=100_000, type=int,
+                        help='frames to play for each seed')
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int,
+                        help='number of worker processes')
+    options = parser.parse_args(args[1:])
+
+    if options.command == 'replay':
+        with open(options.file) as file:
+            repro = json.load(file)
+        engine = load_engine(options.candidate)
+        actions = [tuple(action) for action in repro['actions']]
+        divergence = compare(engine, repro['seed'], actions)
+        print(json.dumps({'divergence': divergence}))
+        sys.exit(1 if divergence else 0)
+
+    tasks = [(options.candidate, seed, options.frames)
+             for seed in options.seeds]
+    start = time.perf_counter()
+    if options.workers == 1:
+        results = [_fuzz(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=options.workers) as executor:
+            results = list(executor.map(_fuzz, tasks))
+    duration = time.perf_counter() - start
+    failures = [result for result in results if result['fields']]
+    frames = sum(result['frames'] for result in results)
+    print(json.dumps({
+        'candidate': options.candidate,
+        'seeds': len(results),
+        'frames': frames,
+        'actions': sum(result['actions'] for result in results),
+        'frames_per_second': frames / duration,
+        'coverage': {rule: sum(result['coverage'].get(rule, 0)
+                               for result in results)
+                     for rule in COVERAGE},
+        'failures': [{key: result[key] for key in
+                      ('seed', 'divergence', 'fields')}
+                     | {'repro_actions': len(result['repro'])}
+                     for result in failures],
+    }, indent=2))
+    if failures:
+        if options.file is not None:
+            failure = failures[0]
+            with open(options.file, 'w') as file:
+                json.dump({'seed': failure['seed'],
+                           'candidate': failure['candidate'],
+                           'fields': failure['fields'],
+                           'actions': failure['repro']}, file)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
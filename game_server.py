@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Hosts many TetrisGame sessions in one asyncio event loop, for bots that play
+over the network. Every connection is one session. All games advance
+together on a shared tick, and each client gets at most one state update per
+tick, holding everything that changed.
+
+Client messages are fixed-size: type, sequence number and two arguments.
+
+    INPUT       set the next input (Input value), registered on a tick
+    PLACE       move the current piece to (x, rotation) and hard drop it
+    RESET       start a new game
+
+PLACE takes x from 0 to 10 and a rotation from 0 to 3. A client that sends
+anything else is disconnected.
+
+Server updates are the sequence number of the last command applied and the
+length of a spectator.py delta message, followed by that message.
+
+    python3 game_server.py serve localhost:7800
+    python3 game_server.py bench localhost:7800 1000 10
+
+The bench command starts a server process, runs the load generator against
+it and prints sessions per core and placement latency percentiles as JSON.
+'''
+
+from tetris_game import TetrisGame, Input
+from spectator import (get_status, encode_delta, decode_delta,
+                       pack_color_rows)
+from collections import deque
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+import numpy as np
+
+INPUT = 0
+PLACE = 1
+RESET = 2
+
+# type, sequence number, arguments
+_command = struct.Struct('<BIbb')
+# sequence number of the last command applied, length of the delta
+_update = struct.Struct('<IH')
+_empty_rows = np.zeros(40, dtype=np.uint32)
+_inputs = {next_input.value for next_input in Input}
+
+# Commands a session may have waiting. Past this, the server stops reading
+# from the client's socket until the session catches up, so commands are
+# never dropped.
+MAX_COMMANDS = 64
+# Updates are skipped for clients whose unsent data passes this many bytes;
+# the next update then carries everything they missed
+MAX_BUFFERED = 64 * 1024
+
+
+def parse_command(data: bytes) -> tuple:
+    '''
+    Unpacks a client message into (type, sequence number, a, b), or returns
+    None if it is not a valid command: PLACE needs x from 0 to 10 and a
+    rotation from 0 to 3, INPUT an Input value
+    '''
+    command = _command.unpack(data)
+    kind, _, a, b = command
+    if kind == INPUT:
+        valid = a in _inputs
+    elif kind == PLACE:
+        valid = 0 <= a <= 10 and 0 <= b <= 3
+    else:
+        valid = kind == RESET
+    return command if valid else None
+
+
+class Session:
+    '''
+    One client's game, its queued commands and what it was last sent
+    '''
+
+    def __init__(self, writer: asyncio.StreamWriter, frame_rate: int) -> None:
+        self.writer = writer
+        self.game = TetrisGame(frame_rate)
+        self.commands = deque()
+        self.ack = 0
+        self.sent_ack = None
+        self.sent_rows = _empty_rows
+        self.sent_signature = None
+
+    def advance(self) -> None:
+        '''
+        Applies queued commands and runs one frame. Only one input can be
+        registered per frame, so later commands wait for the next tick.
+        '''
+        from simple_ai import move
+
+        game = self.game
+        stepped = False
+        while self.commands:
+            kind, sequence, a, b = self.commands[0]
+            if kind == INPUT:
+                if stepped:
+                    break
+                game.set_next_input(a)
+                game.step()
+                stepped = True
+            elif kind == PLACE:
+                if not game.is_over():
+                    move(game, a, b)
+                stepped = True
+            elif kind == RESET:
+                game.reset()
+            self.commands.popleft()
+            self.ack = sequence
+        if not stepped:
+            # Idle frames only bump a counter
+            game.advance_until_event(1)
+
+    def get_update(self) -> bytes:
+        '''
+        Returns the update for this tick, or None if nothing changed
+        '''
+        game = self.game
+        piece = game.get_current_piece()
+        signature = (game.get_board_hash(), game.get_drops(), piece.kind,
+                     int(piece.position[0]), int(piece.position[1]),
+                     piece.rotation, game.get_hold_piece(), game.get_score(),
+                     game.is_over())
+        if signature == self.sent_signature and self.ack == self.sent_ack:
+            return None
+        rows = pack_color_rows(game.get_board())
+        delta = encode_delta(0, get_status(game), rows,
+                             np.flatnonzero(rows != self.sent_rows))
+        self.sent_signature = signature
+        self.sent_ack = self.ack
+        self.sent_rows = rows
+        return _update.pack(self.ack, len(delta)) + delta
+
+
+class GameServer:
+    '''
+    Accepts clients on a TCP or Unix socket and advances every session
+    frames_per_tick frames per tick, tick_rate times per second
+    '''
+
+    def __init__(self, address: str, tick_rate: int = 60,
+                 frames_per_tick: int = 1) -> None:
+        self.address = address
+        self.tick_rate = tick_rate
+        self.frames_per_tick = frames_per_tick
+        self.sessions = set()
+        self.ticks = 0
+        self.late_ticks = 0
+        self.running = False
+
+    async def serve(self, duration: float = None) -> dict:
+        '''
+        Serves clients until stopped or for duration seconds. Returns server
+        statistics.
+        '''
+        if self.address.startswith('unix:'):
+            if os.path.exists(self.address[5:]):
+                os.remove(self.address[5:])
+            server = await asyncio.start_unix_server(self._handle_client,
+                                                     self.address[5:])
+        else:
+            host, _, port = self.address.rpartition(':')
+            server = await asyncio.start_server(self._handle_client, host,
+                                                int(port))
+        self.running = True
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        async with server:
+            loop = asyncio.get_running_loop()
+            period = 1 / self.tick_rate
+            next_tick = loop.time()
+            while self.running:
+                elapsed = time.perf_counter() - start
+                if duration is not None and elapsed > duration:
+                    break
+                self._tick()
+                next_tick += period
+                delay = next_tick - loop.time()
+                if delay < 0:
+                    # Running behind: skip ahead instead of bursting
+                    self.late_ticks += 1
+                    next_tick = loop.time()
+                await asyncio.sleep(max(0.0, delay))
+        wall = time.perf_counter() - start
+        return {
+            'ticks': self.ticks,
+            'late_ticks': self.late_ticks,
+            'wall_time': wall,
+            'cpu_time': time.process_time() - cpu_start,
+        }
+
+    def stop(self) -> None:
+        self.running = False
+
+    def _tick(self) -> None:
+        for session in list(self.sessions):
+            try:
+                for _ in range(self.frames_per_tick):
+                    session.advance()
+            except Exception as error:
+                # One broken session must not stop the others
+                print(f'Closing session after {error!r}')
+                self.sessions.discard(session)
+                session.writer.close()
+                continue
+            transport = session.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > MAX_BUFFERED:
+                continue
+            update = session.get_update()
+            if update is not None:
+                session.writer.write(update)
+        self.ticks += 1
+
+    async def _handle_client(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+        session = Session(writer, 60)
+        self.sessions.add(session)
+        try:
+            while True:
+                while len(session.commands) >= MAX_COMMANDS:
+                    await asyncio.sleep(1 / self.tick_rate)
+                command = parse_command(
+                        await reader.readexactly(_command.size))
+                if command is None:
+                    break
+                session.commands.append(command)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+
+async def _connect(address: str):
+    if address.startswith('unix:'):
+        return await asyncio.open_unix_connection(address[5:])
+    host, _, port = address.rpartition(':')
+    return await asyncio.open_connection(host, int(port))
+
+
+async def _bot(address: str, duration: float, latencies: [float]) -> int:
+    # Closed-loop bot: sends a random placement, waits for the update that
+    # acknowledges it, records the round trip and repeats
+    reader, writer = await _connect(address)
+    sequence = 0
+    placements = 0
+    end = time.perf_counter() + duration
+    over = False
+    try:
+        while time.perf_counter() < end:
+            sequence += 1
+            if over:
+                writer.write(_command.pack(RESET, sequence, 0, 0))
+            else:
+                writer.write(_command.pack(PLACE, sequence,
+                                           random.randrange(11),
+                                           random.randrange(4)))
+            sent = time.perf_counter()
+            ack = 0
+            while ack != sequence:
+                ack, length = _update.unpack(
+                        await reader.readexactly(_update.size))
+                status, _, _ = decode_delta(await reader.readexactly(length))
+                over = bool(status[8])
+            latencies.append(time.perf_counter() - sent)
+            placements += 1
+    finally:
+        writer.close()
+    return placements
+
+
+async def run_load(address: str, sessions: int, duration: float) -> dict:
+    '''
+    Runs sessions closed-loop bots for duration seconds and returns the
+    number of commands and the round-trip latency percentiles in ms
+    '''
+    latencies = []
+    counts = await asyncio.gather(*[_bot(address, duration, latencies)
+                                    for _ in range(sessions)])
+    latencies = np.array(latencies) * 1000
+    return {
+        'sessions': sessions,
+        'commands': int(sum(counts)),
+        'commands_per_second': sum(counts) / duration,
+        'latency_ms': {f'p{p}': float(np.percentile(latencies, p))
+                       for p in [50, 90, 99, 99.9]}
+                      | {'max': float(latencies.max())},
+    }
+
+
+def _serve_for(address: str, duration: float, results) -> None:
+    results.put(asyncio.run(GameServer(address).serve(duration)))
+
+
+def bench(address: str, sessions: int, duration: float) -> dict:
+    '''
+    Starts a server process, loads it with sessions bots for duration
+    seconds and returns the load results plus the server's CPU use
+    '''
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve_for,
+                                     args=(address, duration + 2, results))
+    server.start()
+    time.sleep(1)
+    report = asyncio.run(run_load(address, sessions, duration))
+    server_stats = results.get()
+    server.join()
+    utilization = server_stats['cpu_time'] / server_stats['wall_time']
+    report['server'] = server_stats
+    report['server_cpu_utilization'] = utilization
+    report['sessions_per_core'] = sessions / max(utilization, 1e-9)
+    return report
+
+
+def main(args: [str]) -> None:
+    if len(args) > 2 and args[1] == 'serve':
+        asyncio.run(GameServer(args[2]).serve())
+    elif len(args) > 2 and args[1] == 'bench':
+        sessions = int(args[3]) if len(args) > 3 else 100
+        duration = float(args[4]) if len(args) > 4 else 10.0
+        print(json.dumps(bench(args[2], sessions, duration), indent=2))
+    else:
+        print(f'usage: {args[0]} serve ADDRESS | '
+              'bench ADDRESS [SESSIONS] [SECONDS]')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
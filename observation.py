@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from tetris_game import TetrisGame
+import numpy as np
+
+# Bit weights of the 10 columns of a row, column 0 is the lowest bit
+_column_bits = (1 << np.arange(10)).astype(np.uint16)
+
+
+def encode_color_board(board: np.ndarray) -> np.ndarray:
+    '''
+    Returns a copy of a board (or batch of boards) with the color values
+    stored in one byte per cell instead of eight.
+    '''
+    return board.astype(np.uint8)
+
+
+def pack_rows(boards: np.ndarray) -> np.ndarray:
+    '''
+    Packs a binary or color board, or a batch of them, into one uint16 per
+    row, with bit j set when column j is occupied. The last axis must be the
+    10 columns. A 21x10 board becomes 42 bytes.
+    '''
+    occupied = (boards != 0).astype(np.uint16)
+    return (occupied * _column_bits).sum(axis=-1, dtype=np.uint16)
+
+
+def unpack_rows(packed: np.ndarray) -> np.ndarray:
+    '''
+    Inverse of pack_rows. Returns binary uint8 boards with 10 columns.
+    '''
+    return ((packed[..., None] & _column_bits) != 0).astype(np.uint8)
+
+
+def pack_bits(boards: np.ndarray) -> np.ndarray:
+    '''
+    Packs each board of a batch (or a single board) into a flat bit string
+    with np.packbits. The last two axes are the rows and columns. A 21x10
+    board becomes 27 bytes.
+    '''
+    boards = np.asarray(boards)
+    flat = (boards != 0).reshape(boards.shape[:-2] + (-1,))
+    return np.packbits(flat, axis=-1)
+
+
+def unpack_bits(packed: np.ndarray, rows: int = 21,
+                columns: int = 10) -> np.ndarray:
+    '''
+    Inverse of pack_bits. Returns binary uint8 boards of the given size.
+    '''
+    flat = np.unpackbits(packed, axis=-1, count=rows * columns)
+    return flat.reshape(packed.shape[:-1] + (rows, columns))
+
+
+def get_packed_simple_board(game: TetrisGame) -> np.ndarray:
+    '''
+    Returns the game's simple board (see TetrisGame.get_simple_board) packed
+    one uint16 per row.
+    '''
+    return pack_rows(game.get_simple_board())
@@ -23,8 +23,25 @@
 from tetris_game import TetrisGame, Piece, Color
 import numpy as np
 import pygame
+import math
+import os
 
 BLOCK_SIZE = 20
+# The font ships next to this file, so windows open from any directory
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'LiberationSans-Regular.ttf')
+
+# RGB color of every Color value, as drawn by Renderer
+PALETTE = np.array([
+    (0, 0, 0),
+    (0, 255, 255),
+    (0, 0, 255),
+    (255, 127, 0),
+    (255, 255, 0),
+    (0, 255, 0),
+    (255, 0, 0),
+    (128, 0, 128),
+], dtype=np.uint8)
 
 
 class Renderer:
@@ -56,7 +73,7 @@ class Renderer:
         pygame.init()
         self.screen = pygame.display.set_mode((16 * BLOCK_SIZE,
                                                30 * BLOCK_SIZE))
-        self.font = pygame.freetype.Font('LiberationSans-Regular.ttf', 12)
+        self.font = pygame.freetype.Font(FONT_PATH, 12)
         self.rerender()
 
     def rerender(self) -> None:
@@ -165,4 +182,103 @@ class Renderer:
 
     def _render_game_bumpiness(self) -> None:
         self.font.render_to(self.screen, (10, 100),
-                            f'Bumpiness: {self.game.get_bumpiness()}', (255, 255, 255))  
\ No newline at end of file
+                            f'Bumpiness: {self.game.get_bumpiness()}', (255, 255, 255))
+
+
+class GridRenderer:
+    '''
+    Draws many TetrisGame objects at once as thumbnails in a grid, either in
+    a window or on an offscreen surface. Cells are scaled down to fit the
+    surface, and each call to rerender only redraws the tiles of games that
+    changed since the previous frame, so watching a large batch stays cheap.
+    '''
+
+    def __init__(self, games: [TetrisGame], size: (int, int) = (1280, 720),
+                 offscreen: bool = False) -> None:
+        self.games = list(games)
+        self.size = size
+        self.offscreen = offscreen
+        self.signatures = []
+
+    def get_games(self) -> [TetrisGame]:
+        '''
+        Getter for game objects
+        '''
+        return self.games
+
+    def set_games(self, games: [TetrisGame]) -> None:
+        '''
+        Setter for game objects
+        '''
+        self.games = list(games)
+        self._layout()
+
+    def get_surface(self) -> pygame.Surface:
+        '''
+        Returns the surface the grid is drawn on
+        '''
+        return self.screen
+
+    def setup(self) -> None:
+        '''
+        Run this function to render the first frame
+        '''
+        if self.offscreen:
+            self.screen = pygame.Surface(self.size)
+        else:
+            pygame.init()
+            self.screen = pygame.display.set_mode(self.size)
+        self._layout()
+        self.rerender()
+
+    def rerender(self) -> int:
+        '''
+        Redraws the tiles of games that changed and returns how many there
+        were
+        '''
+        dirty = []
+        for i, game in enumerate(self.games):
+            piece = game.get_current_piece()
+            signature = (game.get_board_hash(), game.get_drops(), piece.kind,
+                         int(piece.position[0]), int(piece.position[1]),
+                         piece.rotation, game.is_over())
+            if signature != self.signatures[i]:
+                self.signatures[i] = signature
+                dirty.append(self._render_tile(i, game))
+        if dirty and not self.offscreen:
+            pygame.display.update(dirty)
+        return len(dirty)
+
+    def _layout(self) -> None:
+        # Pick the number of columns that gives the largest cells
+        count = max(1, len(self.games))
+        width, height = self.size
+        best = (0, 1)
+        for columns in range(1, count + 1):
+            rows = math.ceil(count / columns)
+            cell = min(width // columns // 11, height // rows // 22)
+            if cell > best[0]:
+                best = (cell, columns)
+        self.cell_size = max(1, best[0])
+        self.columns = best[1]
+        self.signatures = [None] * len(self.games)
+        if hasattr(self, 'screen'):
+            self.screen.fill((50, 50, 50))
+            if not self.offscreen:
+                pygame.display.flip()
+
+    def _render_tile(self, i: int, game: TetrisGame) -> pygame.Rect:
+        _, board = game.convert_piece_to_board(game.get_current_piece())
+        game.combine_boards(board, game.get_board())
+        colors = PALETTE[board[19:]]
+        if game.is_over():
+            colors = colors // 3
+        tile = pygame.Surface((10, 21))
+        pygame.surfarray.blit_array(tile, colors.transpose(1, 0, 2))
+        rect = pygame.Rect((i % self.columns) * 11 * self.cell_size
+                           + self.cell_size // 2,
+                           (i // self.columns) * 22 * self.cell_size
+                           + self.cell_size // 2,
+                           10 * self.cell_size, 21 * self.cell_size)
+        self.screen.blit(pygame.transform.scale(tile, rect.size), rect)
+        return rect
@@ -20,27 +20,132 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from tetris_game import TetrisGame, Input
-from renderer import Renderer
-import pygame
+from __future__ import annotations
+from tetris_game import (TetrisGame, Input, AfterstateCache, StepResult,
+                         Piece, piece_cells, clamp_position, get_column_stats)
+from viewer import ViewerProcess, HeadlessRenderer
+from features import LinearEvaluator, get_placement_features
+from finesse import play_inputs
+from typing import TYPE_CHECKING
+import tracing
+import telemetry
+import checkpoint
+import json
+import os
 import copy
 import numpy as np
 import random
 import sys
+import time
+
+# pygame is only imported when a window is opened, so headless users of this
+# module (evaluation workers, dataset generation) start quickly
+if TYPE_CHECKING:
+    from renderer import Renderer
+    import pygame
+
+# Score for clearing 0 to 4 lines without a t-spin or back-to-back tetris
+line_scores = [0, 1, 3, 5, 8]
+
+# Afterstates (score gained, holes, bumpiness, height) by board hash, piece
+# kind, move state and placement key, shared by every call to get_utility
+utility_cache = AfterstateCache(100_000)
+
+
+def get_move_state(game: TetrisGame) -> tuple:
+    '''
+    Returns everything apart from the board and the piece kind that decides
+    where move takes the current piece: its position and rotation, the
+    frames per row of gravity (which covers the level, soft drop and lock
+    delay), the frames already waited and the lock delay resets used
+    '''
+    piece = game.get_current_piece()
+    return (int(piece.position[0]), int(piece.position[1]), piece.rotation,
+            game.get_gravity_frames(), game.waited_frames, game.lock_count)
+
+
+def get_placement_key(kind: int, position: int, rotation: int) -> tuple:
+    '''
+    Returns the columns and shape of the cells a piece covers after moving
+    to position (clamped against the walls, as move ends up doing) and
+    rotation. The piece is then dropped straight down, so placements with
+    the same key end on the same cells. This is how the symmetric rotations
+    of the O, I, S and Z pieces and positions past a wall are recognized.
+    '''
+    cells = piece_cells[kind][rotation]
+    x = clamp_position(kind, rotation, position)
+    cells = cells + np.array([x, -cells[:, 1].min()])
+    return tuple(sorted(map(tuple, cells.tolist())))
+
+
+# get_placement_key of every kind, rotation and position from 0 to 10
+placement_keys = [[[get_placement_key(kind, position, rotation)
+                    for position in range(11)]
+                   for rotation in range(4)]
+                  for kind in range(7)]
+
+
+def _get_placement_key(kind: int, position: int, rotation: int) -> tuple:
+    if 0 <= position <= 10:
+        return placement_keys[kind][rotation][position]
+    return get_placement_key(kind, position, rotation)
+
+
+def get_distinct_actions(kind: int,
+                         actions: [(int, int)]) -> [(int, int)]:
+    '''
+    Returns the (position, rotation) actions that lead to distinct
+    placements of a piece of the given kind, keeping the first action of
+    every group in the given order. With a shuffled list, ties between
+    distinct placements are broken the same way for a given random seed.
+    '''
+    seen = set()
+    distinct = []
+    for position, rotation in actions:
+        key = _get_placement_key(kind, position, rotation)
+        if key not in seen:
+            seen.add(key)
+            distinct.append((position, rotation))
+    return distinct
+
+
+def _step(game: TetrisGame, renderer: Renderer = None,
+          clock: pygame.time.Clock = None) -> StepResult:
+    # One frame, drawn and paced if there is a renderer and clock
+    with tracing.span('step'):
+        result = game.step()
+    if renderer is not None:
+        with tracing.span('render'):
+            renderer.rerender()
+        if clock is not None:
+            with tracing.span('clock.tick'):
+                clock.tick(game.get_frame_rate())
+    return result
 
 
 def move(game: TetrisGame, absolute_position: int, rotation: int,
-         renderer: Renderer = None, clock: pygame.time.Clock = None) -> None:
+         renderer: Renderer = None,
+         clock: pygame.time.Clock = None) -> StepResult:
+    with tracing.span('move'):
+        # Take the shortest input sequence when nothing gets in its way,
+        # otherwise finish step by step from wherever the piece ended up
+        if not play_inputs(game, absolute_position, rotation, renderer,
+                           clock):
+            _move_step_by_step(game, absolute_position, rotation, renderer,
+                               clock)
+        game.set_next_input(Input.HARD_DROP.value)
+        return _step(game)
+
+
+def _move_step_by_step(game: TetrisGame, absolute_position: int,
+                       rotation: int, renderer: Renderer = None,
+                       clock: pygame.time.Clock = None) -> None:
     last_rotation = 100
     current_rotation = game.get_current_piece().rotation
     while (game.get_current_piece().rotation != rotation
            and last_rotation != current_rotation):
         game.set_next_input(Input.C_ROTATE.value)
-        game.step()
-        if renderer is not None:
-            renderer.rerender()
-            if clock is not None:
-                clock.tick(game.get_frame_rate())
+        _step(game, renderer, clock)
         last_rotation = current_rotation
         current_rotation = game.get_current_piece().rotation
 
@@ -49,11 +154,7 @@ def move(game: TetrisGame, absolute_position: int, rotation: int,
     while (current_position > absolute_position
            and last_position != current_position):
         game.set_next_input(Input.MOVE_LEFT.value)
-        game.step()
-        if renderer is not None:
-            renderer.rerender()
-            if clock is not None:
-                clock.tick(game.get_frame_rate())
+        _step(game, renderer, clock)
         last_position = current_position
         current_position = game.get_current_piece().position[0]
 
@@ -62,37 +163,52 @@ def move(game: TetrisGame, absolute_position: int, rotation: int,
     while (current_position < absolute_position
            and last_position != current_position):
         game.set_next_input(Input.MOVE_RIGHT.value)
-        game.step()
-        if renderer is not None:
-            renderer.rerender()
-            if clock is not None:
-                clock.tick(game.get_frame_rate())
+        _step(game, renderer, clock)
         last_position = current_position
         current_position = game.get_current_piece().position[0]
 
-    game.set_next_input(Input.HARD_DROP.value)
-    game.step()
 
+def get_afterstate(game: TetrisGame, position: int,
+                   rotation: int) -> (int, int, int, int):
+    '''
+    Returns the score gained and the resulting holes, bumpiness and aggregate
+    height after moving the current piece to the given position and rotation
+    and hard dropping it.
+    '''
+    with tracing.span('simulate'):
+        # The simulated lock may draw a new 7-bag from the global random
+        # state, which must not depend on how many candidates were simulated
+        random_state = random.getstate()
+        new_game = copy.deepcopy(game)
+        move(new_game, position, rotation)
+        random.setstate(random_state)
+    return (new_game.get_score() - game.get_score(),
+            new_game.get_number_holes(), new_game.get_bumpiness(),
+            new_game.get_aggregate_height())
 
-def get_utility(game: TetrisGame, position: int, rotation: int, w_1: int,
-                w_2: int, w_3: int) -> float:
-    old_bumpiness = game.get_bumpiness()
-    old_holes = game.get_number_holes()
-    old_height = game.get_aggregate_height()
-    old_score = game.get_score()
-
-    new_game = copy.deepcopy(game)
-    move(new_game, position, rotation)
 
-    new_bumpiness = new_game.get_bumpiness()
-    new_holes = new_game.get_number_holes()
-    new_height = new_game.get_aggregate_height()
-    new_score = new_game.get_score()
+def get_utility(game: TetrisGame, position: int, rotation: int, w_1: int,
+                w_2: int, w_3: int,
+                cache: AfterstateCache = utility_cache) -> float:
+    # The move is played frame by frame, so the afterstate depends on the
+    # gravity and the piece's starting pose as well as on the board and the
+    # placement. With all of them in the key, entries can be shared between
+    # decisions, games and weight sets. Pass cache=None to bypass.
+    if cache is None:
+        afterstate = get_afterstate(game, position, rotation)
+    else:
+        kind = game.get_current_piece().kind
+        key = (game.get_board_hash(), kind, get_move_state(game),
+               _get_placement_key(kind, position, rotation))
+        afterstate = cache.get(key)
+        if afterstate is None:
+            afterstate = get_afterstate(game, position, rotation)
+            cache.put(key, afterstate)
+    score_delta, new_holes, new_bumpiness, new_height = afterstate
 
-    bumpiness_delta = new_bumpiness - old_bumpiness
-    holes_delta = new_holes - old_holes
-    height_delta = new_height - old_height
-    score_delta = new_score - old_score
+    bumpiness_delta = new_bumpiness - game.get_bumpiness()
+    holes_delta = new_holes - game.get_number_holes()
+    height_delta = new_height - game.get_aggregate_height()
 
     utility = (1000 * score_delta - w_1 * holes_delta - w_2 * bumpiness_delta
                - w_3 * height_delta)
@@ -101,13 +217,23 @@ def get_utility(game: TetrisGame, position: int, rotation: int, w_1: int,
 
 def get_next_move(game: TetrisGame, w_1: int, w_2: int,
                   w_3: int) -> (int, int):
+    with tracing.span('get_next_move'):
+        return _get_next_move(game, w_1, w_2, w_3)
+
+
+def _get_next_move(game: TetrisGame, w_1: int, w_2: int,
+                   w_3: int) -> (int, int):
     next_actions = []
     for i in range(11):
         for j in range(4):
             next_actions.append((i, j))
 
-    # Don't favor any particular move when utility is equal
+    # Don't favor any particular move when utility is equal. Only one action
+    # per distinct placement is simulated, the first in shuffled order, which
+    # is the one that won ties between equivalent actions before.
     random.shuffle(next_actions)
+    next_actions = get_distinct_actions(game.get_current_piece().kind,
+                                        next_actions)
 
     max_utility = -np.inf
     for action in next_actions:
@@ -118,6 +244,126 @@ def get_next_move(game: TetrisGame, w_1: int, w_2: int,
     return best_action
 
 
+def get_board_stats(board: np.ndarray) -> (int, int, int):
+    '''
+    Returns the holes, bumpiness and aggregate height of a board, computed
+    in one vectorized pass the same way TetrisGame computes them when a
+    piece locks.
+    '''
+    heights, holes, bumpiness = get_column_stats(board[19:] != 0)
+    return (int(np.count_nonzero(holes)), int(bumpiness),
+            int(heights.sum()))
+
+
+def estimate_utility(game: TetrisGame, position: int, rotation: int,
+                     w_1: int, w_2: int, w_3: int) -> float:
+    '''
+    Cheap estimate of get_utility. The piece is put straight into the target
+    rotation, clamped against the walls and dropped analytically, instead of
+    simulating the inputs frame by frame, so kicks and gravity during the
+    move are ignored.
+    '''
+    current = game.get_current_piece()
+    cells = piece_cells[current.kind][rotation]
+    x = clamp_position(current.kind, rotation, position)
+    piece = Piece(current.kind, np.array([x, current.position[1]]), rotation)
+    distance = game.get_drop_distance(piece)
+    if distance < 0:
+        return -np.inf
+    board = game.get_board() != 0
+    cells = cells + piece.position + np.array([0, distance])
+    board[cells[:, 1], cells[:, 0]] = True
+    lines = np.count_nonzero(board.all(axis=1))
+    holes, bumpiness, height = get_board_stats(board)
+    return (1000 * line_scores[lines]
+            - w_1 * (holes - game.get_number_holes())
+            - w_2 * (bumpiness - game.get_bumpiness())
+            - w_3 * (height - game.get_aggregate_height()))
+
+
+def get_next_move_anytime(game: TetrisGame, w_1: int, w_2: int, w_3: int,
+                          budget_ms: float) -> ((int, int), int):
+    '''
+    Like get_next_move, but returns within roughly budget_ms milliseconds.
+    Candidates are ranked with estimate_utility first, then evaluated with
+    the full get_utility in that order until time runs out. Returns the best
+    move found and how many candidates got the full evaluation. If none did,
+    the best estimate is returned.
+    '''
+    deadline = time.perf_counter() + budget_ms / 1000
+    next_actions = []
+    for i in range(11):
+        for j in range(4):
+            next_actions.append((i, j))
+
+    # Don't favor any particular move when utility is equal. The sort is
+    # stable, so equal estimates keep this order.
+    random.shuffle(next_actions)
+    next_actions = get_distinct_actions(game.get_current_piece().kind,
+                                        next_actions)
+    estimates = {action: estimate_utility(game, action[0], action[1], w_1,
+                                          w_2, w_3)
+                 for action in next_actions}
+    next_actions.sort(key=estimates.get, reverse=True)
+
+    best_action = next_actions[0]
+    max_utility = -np.inf
+    evaluated = 0
+    for action in next_actions:
+        if time.perf_counter() >= deadline:
+            break
+        utility = get_utility(game, action[0], action[1], w_1, w_2, w_3)
+        evaluated += 1
+        if utility > max_utility:
+            max_utility = utility
+            best_action = action
+    return best_action, evaluated
+
+
+def get_next_move_linear(game: TetrisGame,
+                         evaluator: LinearEvaluator) -> (int, int):
+    '''
+    Like get_next_move, but every placement is dropped analytically (see
+    features.get_placement_features) and valued with the evaluator's
+    weights, all in one batch.
+    '''
+    next_actions = []
+    for i in range(11):
+        for j in range(4):
+            next_actions.append((i, j))
+
+    # Don't favor any particular move when values are equal
+    random.shuffle(next_actions)
+    piece = game.get_current_piece()
+    features, valid = get_placement_features(game.get_board(), piece.kind,
+                                             next_actions, piece.position[1])
+    values = np.where(valid, evaluator.evaluate(features), -np.inf)
+    return next_actions[int(np.argmax(values))]
+
+
+def save_search(directory: str, weights: (int, int, int), score_table: dict,
+                games: int, score_total: int) -> str:
+    '''
+    Checkpoints the weight search of train mode: the weights being tried,
+    the total scores of every weight set tried so far, the games played with
+    the current weights and their total score
+    '''
+    def write(path):
+        search = {
+            'weights': list(weights),
+            'score_table': [[*key, total]
+                            for key, total in score_table.items()],
+            'best_weights': (list(max(score_table, key=score_table.get))
+                             if score_table else None),
+            'games': games,
+            'score_total': score_total,
+        }
+        with open(os.path.join(path, 'search.json'), 'w') as file:
+            json.dump(search, file)
+        checkpoint.save_random_state(path)
+    return checkpoint.save(directory, write)
+
+
 def main(args: [str]) -> None:
     # Starting weights
     # Currently best weights found so far
@@ -125,34 +371,102 @@ def main(args: [str]) -> None:
     w_2 = 1
     w_3 = 1
 
-    if len(args) > 1 and args[1] == 'train':
+    training = 'train' in args[1:]
+    # In viewer mode the window is drawn by its own process and the AI runs
+    # unthrottled
+    viewer_mode = 'viewer' in args[1:]
+    # In headless mode nothing is drawn and pygame is never loaded
+    headless = 'headless' in args[1:]
+    # In anytime mode the AI thinks for at most as long as the piece takes to
+    # fall one row
+    anytime = 'anytime' in args[1:]
+    # trace or trace=PATH records where the time goes, see tracing.py
+    tracing.enable_from_args(args[1:])
+    # checkpoint or checkpoint=DIR saves the weight search after every game
+    # in train mode, resume continues it from the latest checkpoint
+    checkpoint_dir = checkpoint.get_directory(args[1:],
+                                              'checkpoints/simple_ai')
+
+    resumed = None
+    if training:
         score_table = {}
         score_total = 0
         games = 0
+        if 'resume' in args[1:]:
+            resumed = checkpoint.get_latest(checkpoint_dir)
+        if resumed is not None:
+            with open(os.path.join(resumed, 'search.json')) as file:
+                search = json.load(file)
+            w_1, w_2, w_3 = search['weights']
+            score_table = {tuple(weights): total
+                           for *weights, total in search['score_table']}
+            score_total = search['score_total']
+            games = search['games']
+            checkpoint.load_random_state(resumed)
+            print(f'Resumed from {resumed}')
         print((w_1, w_2, w_3))
+    # metrics or metrics=PATH writes every game and weight set as JSONL, see
+    # telemetry.py. A resumed search adds to the records it already wrote.
+    metrics = telemetry.from_args(args[1:], append=resumed is not None)
+    if resumed is not None:
+        metrics.episodes = games
 
     game = TetrisGame(60)
-    renderer = Renderer(game)
+    if headless:
+        renderer = HeadlessRenderer(game)
+        clock = None
+    elif viewer_mode:
+        renderer = ViewerProcess(game)
+        clock = None
+    else:
+        from renderer import Renderer
+        import pygame
+
+        renderer = Renderer(game)
+        clock = pygame.time.Clock()
     renderer.setup()
     running = True
-
-    clock = pygame.time.Clock()
+    game_start = time.perf_counter()
 
     while running:
-        position, rotation = get_next_move(game, w_1, w_2, w_3)
-        renderer.rerender()
-        clock.tick(game.get_frame_rate())
+        with tracing.span('decide'):
+            if anytime:
+                budget_ms = (1000 * game.get_gravity_frames()
+                             / game.get_frame_rate())
+                (position, rotation), _ = get_next_move_anytime(
+                        game, w_1, w_2, w_3, budget_ms)
+            else:
+                position, rotation = get_next_move(game, w_1, w_2, w_3)
+        with tracing.span('render'):
+            renderer.rerender()
+        if clock is not None:
+            with tracing.span('clock.tick'):
+                clock.tick(game.get_frame_rate())
         move(game, position, rotation, renderer, clock)
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+        with tracing.span('events'):
+            if viewer_mode or headless:
+                running = renderer.is_running()
+            else:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        running = False
         if game.is_over():
-            if len(args) > 1 and args[1] == 'train':
+            metrics.log_episode(score=game.get_score(),
+                                pieces=game.get_drops(),
+                                lines=game.get_lines(),
+                                duration=time.perf_counter() - game_start,
+                                weights=[w_1, w_2, w_3])
+            if training:
                 games += 1
                 score_total += game.get_score()
                 if games >= 12:
                     score_table[(w_1, w_2, w_3)] = score_total
                     new_weights = max(score_table, key=score_table.get)
+                    metrics.log('weights', weights=[w_1, w_2, w_3],
+                                average_score=score_total / 12,
+                                best_weights=list(new_weights),
+                                best_average_score=(score_table[new_weights]
+                                                    / 12))
                     while (w_1, w_2, w_3) in score_table:
                         w_1 = max(1, new_weights[0] + random.randint(-10, 10))
                         w_2 = max(1, new_weights[1] + random.randint(-10, 10))
@@ -163,8 +477,17 @@ def main(args: [str]) -> None:
                         f'With average score: {score_table[new_weights] / 12}')
                     games = 0
                     score_total = 0
+                if checkpoint_dir is not None:
+                    save_search(checkpoint_dir, (w_1, w_2, w_3), score_table,
+                                games, score_total)
             game.reset()
-        clock.tick(game.get_frame_rate())
+            game_start = time.perf_counter()
+        if clock is not None:
+            with tracing.span('clock.tick'):
+                clock.tick(game.get_frame_rate())
+    metrics.close()
+    if viewer_mode:
+        renderer.close()
 
 
 if __name__ == '__main__':
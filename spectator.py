@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Streams live games to remote viewers, so self-play can be watched without
+running pygame on the compute hosts. Run a demo server with random games and
+watch it with:
+
+    python3 spectator.py serve localhost:7777 8
+    python3 spectator.py watch localhost:7777
+
+Addresses are either HOST:PORT for TCP or unix:PATH for a Unix socket. In the
+viewer, the left and right arrow keys switch between games. Add 'grid' after
+the address to watch all games at once.
+
+Every message is one game's status (piece, queue, hold, scores) followed by
+the board rows that changed since the game was last published, with each row
+packed as ten 3-bit colors. Messages for any number of games are multiplexed
+on one connection, and games that did not change send nothing.
+'''
+
+from tetris_game import TetrisGame, Piece, hash_board
+import numpy as np
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+# game id, kind, x, y, rotation, hold, level, score, over, aggregate height,
+# bumpiness, holes, 6 next pieces, number of changed rows
+_status = struct.Struct('<HbbbBbHIBHHH6bB')
+# row index, packed colors
+_row = struct.Struct('<BI')
+_color_shifts = (3 * np.arange(10)).astype(np.uint32)
+_empty_rows = np.zeros(40, dtype=np.uint32)
+
+# Deltas are no longer queued for viewers whose unsent data passes this many
+# bytes. Once they have caught up, they get a full frame of every game.
+MAX_BUFFERED = 64 * 1024
+
+
+def pack_color_rows(board: np.ndarray) -> np.ndarray:
+    '''
+    Packs each row of a board into a uint32 holding ten 3-bit colors
+    '''
+    return (board.astype(np.uint32) << _color_shifts).sum(axis=-1,
+                                                         dtype=np.uint32)
+
+
+def unpack_color_rows(rows: np.ndarray) -> np.ndarray:
+    '''
+    Inverse of pack_color_rows
+    '''
+    return ((rows[..., None] >> _color_shifts) & 7).astype(int)
+
+
+def get_status(game: TetrisGame) -> tuple:
+    '''
+    Returns everything a viewer needs about a game apart from the board
+    '''
+    piece = game.get_current_piece()
+    next_pieces = game.get_next_pieces()
+    return (piece.kind, int(piece.position[0]), int(piece.position[1]),
+            piece.rotation, game.get_hold_piece(), game.get_level(),
+            game.get_score(), game.is_over(), game.get_aggregate_height(),
+            game.get_bumpiness(), game.get_number_holes(),
+            *next_pieces, *[-1] * (6 - len(next_pieces)))
+
+
+def encode_delta(game_id: int, status: tuple, rows: np.ndarray,
+                 changed: np.ndarray) -> bytes:
+    '''
+    Returns the message for a game's status and the packed rows at the
+    given indices
+    '''
+    message = [_status.pack(game_id, *status, len(changed))]
+    for i in changed:
+        message.append(_row.pack(i, rows[i]))
+    return b''.join(message)
+
+
+def decode_delta(buffer: bytes, offset: int = 0) -> (tuple, list, int):
+    '''
+    Decodes the message at offset. Returns the game id and status, the
+    changed (row index, packed row) pairs and the message size, or None if
+    the buffer does not hold the whole message yet.
+    '''
+    if len(buffer) - offset < _status.size:
+        return None
+    status = _status.unpack_from(buffer, offset)
+    size = _status.size + status[-1] * _row.size
+    if len(buffer) - offset < size:
+        return None
+    rows = [_row.unpack_from(buffer, offset + _status.size + i * _row.size)
+            for i in range(status[-1])]
+    return status[:-1], rows, size
+
+
+def apply_delta(game: TetrisGame, status: tuple, rows: [(int, int)]) -> None:
+    '''
+    Applies a decoded message (without its game id) to a mirror game
+    '''
+    (kind, x, y, rotation, hold, level, score, over, aggregate_height,
+     bumpiness, holes) = status[:11]
+    if rows:
+        indices, values = zip(*rows)
+        game.board[list(indices)] = unpack_color_rows(
+                np.array(values, dtype=np.uint32))
+        game.board_hash = hash_board(game.board)
+    game.piece = Piece(kind, np.array([x, y]), rotation)
+    game.hold_piece = hold
+    game.level = level
+    game.score = score
+    game.is_game_over = bool(over)
+    game.aggregate_height = aggregate_height
+    game.bumpiness = bumpiness
+    game.number_holes = holes
+    game.piece_queue = [kind for kind in status[11:17] if kind >= 0]
+
+
+def create_mirror() -> TetrisGame:
+    '''
+    Returns an empty game to apply messages to
+    '''
+    game = TetrisGame(60)
+    game.board = np.zeros((40, 10), dtype=int)
+    return game
+
+
+def _open_socket(address: str) -> (socket.socket, object):
+    if address.startswith('unix:'):
+        return socket.socket(socket.AF_UNIX), address[5:]
+    host, _, port = address.rpartition(':')
+    return socket.socket(socket.AF_INET), (host, int(port))
+
+
+class _Viewer:
+    # A viewer's non-blocking socket and the data not yet sent to it
+    def __init__(self, connection: socket.socket) -> None:
+        connection.setblocking(False)
+        self.connection = connection
+        self.buffer = bytearray()
+        self.needs_keyframe = True
+
+
+class SpectatorServer:
+    '''
+    Streams state deltas of any number of games to every connected viewer.
+    Call publish after stepping a game. Sending happens on a background
+    thread at a fixed rate, so the game loop never waits on the network.
+    Viewers that connect late first receive a full frame of every game, and
+    so do viewers that fell MAX_BUFFERED bytes behind, once they catch up.
+    A stalled viewer therefore never holds up the others.
+    '''
+
+    def __init__(self, address: str, rate: int = 60) -> None:
+        self.address = address
+        self.rate = rate
+        self.rows = {}
+        self.statuses = {}
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.clients = []
+        self.bytes_sent = 0
+        self.running = False
+        self.thread = None
+
+    def start(self) -> None:
+        '''
+        Starts listening for viewers
+        '''
+        self.listener, address = _open_socket(self.address)
+        if self.listener.family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.remove(address)
+        else:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                     1)
+        self.listener.bind(address)
+        self.listener.listen()
+        self.listener.settimeout(1 / self.rate)
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def publish(self, game_id: int, game: TetrisGame) -> None:
+        '''
+        Queues whatever changed in game since it was last published
+        '''
+        rows = pack_color_rows(game.get_board())
+        changed = np.flatnonzero(rows != self.rows.get(game_id, _empty_rows))
+        status = get_status(game)
+        if len(changed) == 0 and status == self.statuses.get(game_id):
+            return
+        message = encode_delta(game_id, status, rows, changed)
+        with self.lock:
+            self.pending += message
+            self.rows[game_id] = rows
+            self.statuses[game_id] = status
+
+    def get_bytes_sent(self) -> int:
+        '''
+        Returns the number of bytes sent to viewers so far
+        '''
+        return self.bytes_sent
+
+    def close(self) -> None:
+        '''
+        Stops the server and disconnects all viewers
+        '''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for viewer in self.clients:
+            viewer.connection.close()
+        self.clients = []
+        self.listener.close()
+
+    def _serve(self) -> None:
+        while self.running:
+            try:
+                connection, _ = self.listener.accept()
+                self.clients.append(_Viewer(connection))
+            except socket.timeout:
+                pass
+            with self.lock:
+                data = bytes(self.pending)
+                self.pending.clear()
+                keyframe = None
+                if any(viewer.needs_keyframe and not viewer.buffer
+                       for viewer in self.clients):
+                    # Every row, so rows emptied since a viewer fell behind
+                    # are cleared too
+                    keyframe = b''.join(
+                            encode_delta(game_id, self.statuses[game_id], rows,
+                                         np.arange(len(rows)))
+                            for game_id, rows in self.rows.items())
+            for viewer in list(self.clients):
+                if viewer.needs_keyframe:
+                    # Deltas only apply on top of a keyframe, which is sent
+                    # once everything queued before it is out
+                    if not viewer.buffer:
+                        viewer.buffer += keyframe
+                        viewer.needs_keyframe = False
+                elif len(viewer.buffer) + len(data) > MAX_BUFFERED:
+                    viewer.needs_keyframe = True
+                else:
+                    viewer.buffer += data
+                self._send(viewer)
+
+    def _send(self, viewer: _Viewer) -> None:
+        if not viewer.buffer:
+            return
+        try:
+            sent = viewer.connection.send(viewer.buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            viewer.connection.close()
+            self.clients.remove(viewer)
+            return
+        del viewer.buffer[:sent]
+        self.bytes_sent += sent
+
+
+class SpectatorClient:
+    '''
+    Connects to a SpectatorServer and keeps a mirror TetrisGame for every
+    streamed game, which a Renderer can draw.
+    '''
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.games = {}
+        self.buffer = bytearray()
+
+    def connect(self) -> None:
+        self.connection, address = _open_socket(self.address)
+        self.connection.connect(address)
+        self.connection.setblocking(False)
+
+    def get_game_ids(self) -> [int]:
+        return sorted(self.games)
+
+    def get_game(self, game_id: int) -> TetrisGame:
+        return self.games[game_id]
+
+    def poll(self) -> int:
+        '''
+        Applies every complete message received so far without blocking.
+        Returns the number of messages applied.
+        '''
+        while True:
+            try:
+                data = self.connection.recv(65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self.buffer += data
+
+        applied = 0
+        offset = 0
+        while True:
+            message = decode_delta(self.buffer, offset)
+            if message is None:
+                break
+            status, rows, size = message
+            if status[0] not in self.games:
+                self.games[status[0]] = create_mirror()
+            apply_delta(self.games[status[0]], status[1:], rows)
+            offset += size
+            applied += 1
+        del self.buffer[:offset]
+        return applied
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def serve(address: str, number_games: int) -> None:
+    server = SpectatorServer(address)
+    server.start()
+    games = [TetrisGame(60) for _ in range(number_games)]
+    while True:
+        start = time.perf_counter()
+        for game_id, game in enumerate(games):
+            game.step()
+            game.set_next_input(random.randint(0, 8))
+            if game.is_over():
+                game.reset()
+            server.publish(game_id, game)
+        time.sleep(max(0.0, 1 / 60 - (time.perf_counter() - start)))
+
+
+def watch(address: str, grid: bool = False) -> None:
+    from renderer import Renderer, GridRenderer
+    import pygame
+
+    client = SpectatorClient(address)
+    client.connect()
+    if grid:
+        renderer = GridRenderer([])
+    else:
+        renderer = Renderer(TetrisGame(60))
+    renderer.setup()
+    clock = pygame.time.Clock()
+    selected = 0
+    running = True
+    while running:
+        client.poll()
+        game_ids = client.get_game_ids()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            if event.type == pygame.KEYDOWN and game_ids:
+                match event.key:
+                    case pygame.K_LEFT:
+                        selected -= 1
+                    case pygame.K_RIGHT:
+                        selected += 1
+        if grid:
+            if len(game_ids) != len(renderer.get_games()):
+                renderer.set_games([client.get_game(game_id)
+                                    for game_id in game_ids])
+        elif game_ids:
+            selected %= len(game_ids)
+            renderer.set_game(client.get_game(game_ids[selected]))
+        renderer.rerender()
+        clock.tick(60)
+    client.close()
+
+
+def main(args: [str]) -> None:
+    if len(args) > 2 and args[1] == 'serve':
+        serve(args[2], int(args[3]) if len(args) > 3 else 1)
+    elif len(args) > 2 and args[1] == 'watch':
+        watch(args[2], 'grid' in args[3:])
+    else:
+        print(f'usage: {args[0]} serve ADDRESS [GAMES] | '
+              'watch ADDRESS [grid]')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Training metrics as JSON lines. Records are buffered and written every few
+seconds, training updates are averaged over an interval instead of logged one
+by one, and rolling aggregates over the last episodes are kept in bounded
+memory, so logging costs the training loop almost nothing. Each line is one
+record with a kind ('episode', 'update' or anything passed to log), the
+seconds since the start and the record's fields.
+'''
+
+from collections import deque
+import atexit
+import json
+import time
+
+
+class Rolling:
+    '''
+    Mean, minimum and maximum of the last window values
+    '''
+
+    def __init__(self, window: int = 100) -> None:
+        self.values = deque(maxlen=window)
+        self.total = 0.0
+
+    def add(self, value: float) -> None:
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+
+    def get_mean(self) -> float:
+        return self.total / len(self.values) if self.values else None
+
+    def get_summary(self) -> dict:
+        if not self.values:
+            return {}
+        return {'mean': self.get_mean(), 'min': min(self.values),
+                'max': max(self.values)}
+
+
+class Telemetry:
+    '''
+    Writes metric records to a JSONL file, or only keeps the rolling
+    aggregates if path is None. With append the records of a resumed run are
+    added to those already in the file.
+    '''
+
+    def __init__(self, path: str = None, window: int = 100,
+                 flush_interval: float = 5.0, update_interval: float = 1.0,
+                 max_buffered: int = 1000, append: bool = False) -> None:
+        self.path = path
+        self.window = window
+        self.flush_interval = flush_interval
+        self.update_interval = update_interval
+        self.max_buffered = max_buffered
+        self.start = time.monotonic()
+        self.last_flush = self.start
+        self.buffer = []
+        self.episodes = 0
+        self.updates = 0
+        self.episode_stats = {}
+        self.update_stats = {}
+        # Sums of the update fields since the last update record
+        self.pending = {}
+        self.pending_count = 0
+        self.last_update_record = self.start
+        if path is not None:
+            # Start a new file unless continuing one, records are appended
+            # from then on
+            if not append:
+                open(path, 'w').close()
+            atexit.register(self.flush)
+
+    def log(self, kind: str, **fields) -> None:
+        '''
+        Adds one record as is
+        '''
+        now = time.monotonic()
+        if self.path is not None:
+            record = {'kind': kind, 'time': round(now - self.start, 3)}
+            record.update(fields)
+            self.buffer.append(json.dumps(record))
+        if (len(self.buffer) >= self.max_buffered
+                or now - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def log_episode(self, **fields) -> None:
+        '''
+        Records a finished episode with its numeric fields' rolling means
+        '''
+        self.episodes += 1
+        rolling = {}
+        for name, value in fields.items():
+            if isinstance(value, (int, float)) and not isinstance(value,
+                                                                  bool):
+                if name not in self.episode_stats:
+                    self.episode_stats[name] = Rolling(self.window)
+                self.episode_stats[name].add(value)
+                rolling[name] = self.episode_stats[name].get_mean()
+        self.log('episode', episode=self.episodes, **fields,
+                 rolling=rolling)
+
+    def log_update(self, **fields) -> None:
+        '''
+        Counts a training update. Its numeric fields are averaged and written
+        as one record per update_interval seconds.
+        '''
+        self.updates += 1
+        self.pending_count += 1
+        for name, value in fields.items():
+            if value is None:
+                continue
+            self.pending[name] = self.pending.get(name, 0.0) + value
+            if name not in self.update_stats:
+                self.update_stats[name] = Rolling(self.window)
+            self.update_stats[name].add(value)
+        now = time.monotonic()
+        if now - self.last_update_record >= self.update_interval:
+            means = {name: total / self.pending_count
+                     for name, total in self.pending.items()}
+            self.log('update', updates=self.updates,
+                     count=self.pending_count, **means)
+            self.pending = {}
+            self.pending_count = 0
+            self.last_update_record = now
+
+    def get_summary(self) -> dict:
+        '''
+        Returns the counts and the rolling aggregates of episode and update
+        fields
+        '''
+        return {
+            'episodes': self.episodes,
+            'updates': self.updates,
+            'episode': {name: stats.get_summary()
+                        for name, stats in self.episode_stats.items()},
+            'update': {name: stats.get_summary()
+                       for name, stats in self.update_stats.items()},
+        }
+
+    def flush(self) -> None:
+        if self.buffer:
+            with open(self.path, 'a') as file:
+                file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+
+
+def from_args(args: [str], append: bool = False) -> Telemetry:
+    '''
+    Returns a Telemetry writing to metrics.jsonl or PATH if the arguments
+    contain metrics or metrics=PATH, otherwise one that only aggregates.
+    Pass append when resuming a run so its earlier records are kept.
+    '''
+    for arg in args:
+        if arg == 'metrics':
+            return Telemetry('metrics.jsonl', append=append)
+        if arg.startswith('metrics='):
+            return Telemetry(arg[len('metrics='):], append=append)
+    return Telemetry()
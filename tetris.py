@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+One entry point for every way of running the game:
+
+    python3 tetris.py play                   play it yourself
+    python3 tetris.py random                 watch random placements
+    python3 tetris.py simple-ai [OPTIONS]    heuristic AI (see simple_ai.py)
+    python3 tetris.py dqn [OPTIONS]          DQN agent (see agent.py)
+    python3 tetris.py eval -p POLICY ...     headless tournament (evaluate.py)
+    python3 tetris.py bench [-p POLICY ...]  startup and throughput numbers
+
+Options after the command are passed on, for example
+`python3 tetris.py simple-ai headless train metrics`. Each command imports
+only the modules it needs, so pygame is only loaded for windows and
+TensorFlow only for the DQN.
+'''
+
+import importlib
+import sys
+
+# Command: module, its entry point, whether that takes the arguments, help
+COMMANDS = {
+    'play': ('playable', 'main', False, 'play it yourself'),
+    'random': ('random_game', 'main', False, 'watch random placements'),
+    'simple-ai': ('simple_ai', 'main', True, 'heuristic AI'),
+    'dqn': ('agent', 'main', True, 'DQN agent'),
+    'eval': ('evaluate', 'main', True, 'headless tournament'),
+    'tune': ('tune', 'main', True, 'cross-entropy weight tuning'),
+    'bench': ('evaluate', 'bench_main', True,
+              'startup and throughput numbers'),
+}
+
+
+def usage() -> str:
+    lines = [f'usage: {sys.argv[0]} COMMAND [OPTIONS]', '', 'commands:']
+    for command, (_, _, _, help) in COMMANDS.items():
+        lines.append(f'    {command:12}{help}')
+    return '\n'.join(lines)
+
+
+def main(args: [str]) -> None:
+    if len(args) < 2 or args[1] not in COMMANDS:
+        print(usage())
+        sys.exit(0 if len(args) > 1 and args[1] in ('-h', '--help') else 2)
+    command = args[1]
+    module, function, takes_args, _ = COMMANDS[command]
+    entry = getattr(importlib.import_module(module), function)
+    if takes_args:
+        entry([f'{args[0]} {command}'] + args[2:])
+    else:
+        entry()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -22,7 +22,9 @@
 
 from enum import Enum
 from dataclasses import dataclass
+from collections import OrderedDict
 import copy
+import math
 import random
 import numpy as np
 
@@ -212,6 +214,118 @@ srs_table_counter_clockwise_I = [
 ]
 
 
+def _get_gravity(level: int) -> float:
+    # Seconds the piece waits before falling a row at the given level
+    return (0.8 - (level - 1) * 0.007)**(level - 1)
+
+
+# Gravity by level (index 0 is level 1), so it is not recomputed every frame
+gravity_table = [_get_gravity(level) for level in range(1, 101)]
+
+
+def _get_piece_cells(kind: int, rotation: int) -> np.ndarray:
+    # Same offsets from the piece position as convert_piece_to_board uses
+    grid = pieces[kind][rotation]
+    center = 1 if len(grid) == 2 else 2
+    return np.array([(j - center, i - 2) for i, row in enumerate(grid)
+                     for j, value in enumerate(row) if value != 0])
+
+
+def _get_piece_bottoms(cells: np.ndarray) -> [(int, int)]:
+    # Lowest cell of the piece in each of its columns
+    bottoms = {}
+    for dx, dy in cells:
+        bottoms[int(dx)] = max(bottoms.get(int(dx), dy), int(dy))
+    return list(bottoms.items())
+
+
+# Offsets (x, y) of the four cells of every piece kind and rotation, relative
+# to the piece position
+piece_cells = [[_get_piece_cells(kind, rotation) for rotation in range(4)]
+               for kind in range(7)]
+# Offsets of the lowest cell in each column the piece covers
+piece_bottoms = [[_get_piece_bottoms(cells) for cells in rotations]
+                 for rotations in piece_cells]
+
+
+def clamp_position(kind: int, rotation: int, x: int) -> int:
+    '''
+    Returns the piece position closest to x that keeps every cell of the
+    piece between the walls, which is where moving towards x stops
+    '''
+    cells = piece_cells[kind][rotation]
+    return min(max(x, -cells[:, 0].min()), 9 - cells[:, 0].max())
+
+
+def get_column_stats(filled: np.ndarray) -> (np.ndarray, np.ndarray,
+                                              np.ndarray):
+    '''
+    Returns the column heights, the holes and the bumpiness of a boolean
+    board, or of each board in a batch. The last two axes are the rows and
+    the 10 columns. Holes are empty cells right below a filled cell, given as
+    a mask one row shorter than the board whose row i is board row i + 1.
+    '''
+    rows = filled.shape[-2]
+    heights = np.where(filled.any(axis=-2), rows - filled.argmax(axis=-2), 0)
+    holes = filled[..., :-1, :] & ~filled[..., 1:, :]
+    bumpiness = np.abs(np.diff(heights, axis=-1)).sum(axis=-1)
+    return heights, holes, bumpiness
+
+
+def _get_kicks(kind: int, rotation: int, is_clockwise: bool) -> tuple:
+    # Rotation the piece ends up in, then every kick as the board offsets of
+    # its cells into one list of candidate cells, as indices into that list
+    new_rotation = (rotation + (1 if is_clockwise else 3)) % 4
+    if kind == 0:
+        table = (srs_table_clockwise_I if is_clockwise
+                 else srs_table_counter_clockwise_I)
+    else:
+        table = (srs_table_clockwise if is_clockwise
+                 else srs_table_counter_clockwise)
+    cells = piece_cells[kind][new_rotation]
+    candidates = []
+    kicks = []
+    for shift in table[new_rotation]:
+        offset = np.array([shift[0], -shift[1]])
+        indices = []
+        for cell in cells + offset:
+            if tuple(cell) not in candidates:
+                candidates.append(tuple(cell))
+            indices.append(candidates.index(tuple(cell)))
+        kicks.append((offset, np.array(indices)))
+    return (new_rotation, np.array(candidates), kicks)
+
+
+# SRS kicks by piece kind, rotation and direction (0 counter clockwise, 1
+# clockwise)
+kick_table = [[[_get_kicks(kind, rotation, is_clockwise)
+                for is_clockwise in (False, True)]
+               for rotation in range(4)] for kind in range(7)]
+
+
+# Zobrist keys, one random 64-bit value per board cell. A board's hash is the
+# XOR of the keys of its occupied cells, so locking a piece or clearing a line
+# only touches the keys of the cells that changed. The fixed seed keeps hashes
+# comparable between processes and runs.
+_zobrist_rng = np.random.default_rng(20231202)
+zobrist_table = _zobrist_rng.integers(0, 2**64 - 1, size=(40, 10),
+                                      dtype=np.uint64, endpoint=True)
+# Extra key mixed in while a back-to-back tetris is pending, since that flag
+# changes the score of the next placement
+zobrist_back_to_back = int(_zobrist_rng.integers(0, 2**64 - 1,
+                                                 dtype=np.uint64,
+                                                 endpoint=True))
+
+
+def hash_board(board: np.ndarray) -> int:
+    '''
+    Returns the Zobrist hash of the occupied cells of a board, or of its
+    first rows if a slice starting at row 0 is given. Colors are ignored.
+    '''
+    keys = zobrist_table[:len(board)][board != 0]
+    return int(np.bitwise_xor.reduce(keys)) if len(keys) else 0
+
+
 class Color(Enum):
     BLANK = 0
     LIGHT_BLUE = 1
@@ -241,6 +355,125 @@ class Piece:
     rotation: int
 
 
+@dataclass
+class StepResult:
+    '''
+    What happened during one step of the game, so callers do not have to
+    poll the getters and compare them with their previous values. The column
+    heights are only filled in when a piece locked.
+    '''
+    locked: bool = False
+    lines_cleared: int = 0
+    t_spin: bool = False
+    score_delta: int = 0
+    level_up: bool = False
+    game_over: bool = False
+    column_heights: np.ndarray = None
+
+
+class LRUCache:
+    '''
+    Bounded least-recently-used cache. The hit and miss counters are there
+    to help tune the capacity.
+    '''
+
+    def __init__(self, capacity: int = 100_000) -> None:
+        assert capacity > 0
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        '''
+        Returns the value stored for key, or None if there is none
+        '''
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: tuple, value) -> None:
+        '''
+        Stores value for key, evicting the least recently used entry if the
+        cache is full
+        '''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        '''
+        Removes all entries and resets the counters
+        '''
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get_hits(self) -> int:
+        return self.hits
+
+    def get_misses(self) -> int:
+        return self.misses
+
+    def get_hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+# Cache for afterstate evaluations, keyed by (board hash, piece kind,
+# placement). Identical boards come up again and again during search and
+# between decisions, so evaluators can look their features up here before
+# simulating a placement.
+AfterstateCache = LRUCache
+
+
+def rotate_piece(board: np.ndarray, piece: Piece, is_clockwise: bool,
+                 cache: LRUCache = None) -> Piece:
+    '''
+    Returns the piece after an SRS rotation on the board, with the first kick
+    that fits, or None if none does. The outcome only depends on which of the
+    cells the kicks could cover are free, so with a cache it is looked up by
+    that pattern and the kicks are only tested once per pattern.
+    '''
+    new_rotation, candidates, kicks = (
+            kick_table[piece.kind][piece.rotation][int(is_clockwise)])
+    cells = candidates + piece.position
+    xs = cells[:, 0]
+    ys = cells[:, 1]
+    # Cells outside the board count as occupied
+    inside = (xs >= 0) & (xs < 10) & (ys >= 0) & (ys < 40)
+    occupied = ~inside
+    occupied[inside] = board[ys[inside], xs[inside]] != 0
+    kick = None
+    if cache is not None:
+        key = (piece.kind, piece.rotation, is_clockwise,
+               np.packbits(occupied).tobytes())
+        kick = cache.get(key)
+    if kick is None:
+        kick = -1
+        for i, (_, indices) in enumerate(kicks):
+            if not occupied[indices].any():
+                kick = i
+                break
+        if cache is not None:
+            cache.put(key, kick)
+    if kick < 0:
+        return None
+    return Piece(piece.kind, piece.position + kicks[kick][0], new_rotation)
+
+
+# Kick outcomes shared by every game, see rotate_piece
+rotation_cache = LRUCache(100_000)
+
+
 class TetrisGame:
     '''
     This class holds all of the game logic for tetris, with no rendering logic
@@ -265,12 +498,14 @@ class TetrisGame:
         self.next_input = Input.NONE.value
         self.level = 1
         self.score = 0
+        self.lines = 0
         self.waited_frames = 0
         self.hold_piece = -1
         self.can_hold = True
         self.piece_queue = []
         self.is_game_over = False
         self.board = np.zeros((40, 10), dtype=int)
+        self.board_hash = 0
         self.soft_drop_mode = False
         self.lock_mode = False
         self.lock_count = 0
@@ -290,6 +525,14 @@ class TetrisGame:
         '''
         return self.board
 
+    def get_board_hash(self) -> int:
+        '''
+        Returns the Zobrist hash of the board occupancy (and of the pending
+        back-to-back flag). It is updated incrementally when pieces lock and
+        lines clear.
+        '''
+        return self.board_hash
+
     def get_drops(self) -> int:
         '''
         Returns the number of drops so far.
@@ -374,12 +617,29 @@ class TetrisGame:
         Return piece information for the "shadow" of the current piece (that
         is, the dark piece that shows you where the piece would land)
         '''
-        new_piece = copy.deepcopy(self.piece)
-        while not self._has_collision(new_piece):
-            new_piece.position[1] += 1
-        new_piece.position[1] -= 1
+        new_piece = Piece(self.piece.kind, self.piece.position.copy(),
+                          self.piece.rotation)
+        new_piece.position[1] += self.get_drop_distance(new_piece)
         return new_piece
 
+    def get_drop_distance(self, piece: Piece) -> int:
+        '''
+        Returns how many rows a piece can fall from its position: the
+        smallest gap between its lowest cell in each column and the first
+        filled cell (or the floor) below it. Returns -1 if the piece already
+        collides, which puts it one row up like the original step-by-step
+        drop did.
+        '''
+        if not self._fits(piece):
+            return -1
+        distance = 40
+        for dx, dy in piece_bottoms[piece.kind][piece.rotation]:
+            x = piece.position[0] + dx
+            y = piece.position[1] + dy
+            filled = np.flatnonzero(self.board[y + 1:, x])
+            distance = min(distance, filled[0] if len(filled) else 39 - y)
+        return int(distance)
+
     def get_current_piece(self) -> Piece:
         '''
         Returns current piece information
@@ -422,14 +682,91 @@ class TetrisGame:
         '''
         return self.score
 
-    def step(self) -> None:
+    def get_lines(self) -> int:
+        '''
+        Returns the number of lines cleared so far
+        '''
+        return self.lines
+
+    def get_column_heights(self) -> np.ndarray:
+        '''
+        Returns the height of every column in the visible 21 rows, measured
+        the same way as the aggregate height
+        '''
+        heights, _, _ = get_column_stats(self.board[19:] != 0)
+        return heights
+
+    def step(self) -> StepResult:
+        '''
+        Run a 'step' (or frame) of the game. Returns what happened during it.
         '''
-        Run a 'step' (or frame) of the game
+        if self.is_game_over:
+            return StepResult(game_over=True)
+        drops = self.drops
+        score = self.score
+        level = self.level
+        self._process_next_input()
+        self._apply_gravity()
+        # _clear_lines resets the t-spin flag set by _lock_piece
+        t_spin = self.t_spin
+        lines_cleared = self._clear_lines()
+        locked = self.drops != drops
+        return StepResult(locked, lines_cleared, t_spin, self.score - score,
+                          self.level != level, self.is_game_over,
+                          self.get_column_heights() if locked else None)
+
+    def step_n(self, frames: int) -> int:
         '''
-        if not self.is_game_over:
-            self._process_next_input()
-            self._apply_gravity()
-            self._clear_lines()
+        Run up to the given number of steps (frames), skipping straight over
+        frames in which nothing happens. Inputs set before the call are
+        registered in the first frame. Returns how many frames elapsed, which
+        is less than asked for only if the game ended.
+        '''
+        elapsed = 0
+        while elapsed < frames and not self.is_game_over:
+            elapsed += self.advance_until_event(frames - elapsed)
+        return elapsed
+
+    def advance_until_event(self, max_frames: int = None) -> int:
+        '''
+        Run steps (frames) until the piece falls a row, locks or starts lock
+        delay, or until a queued input has been registered, but at most
+        max_frames of them. Idle frames are skipped in one jump using the
+        gravity table instead of being simulated one at a time. Returns how
+        many frames elapsed.
+        '''
+        if self.is_game_over or max_frames == 0:
+            return 0
+        # Frames are only idle when no input is queued and the end-of-frame
+        # score update has nothing left to do
+        if (self.next_input != Input.NONE.value or self.t_spin
+                or self.score >= self.level * (self.level + 1) // 2 * 5):
+            self.step()
+            return 1
+        frames = max(1, math.ceil(self.get_gravity_frames())
+                     - self.waited_frames)
+        if max_frames is not None and frames > max_frames:
+            self.waited_frames += max_frames
+            return max_frames
+        self.waited_frames += frames - 1
+        self.step()
+        return frames
+
+    def get_gravity_frames(self) -> float:
+        '''
+        Returns how many frames the piece currently waits before it falls a
+        row (or locks, in lock delay)
+        '''
+        if self.lock_mode:
+            G = 0.5
+        else:
+            if self.level <= len(gravity_table):
+                G = gravity_table[self.level - 1]
+            else:
+                G = _get_gravity(self.level)
+            if self.soft_drop_mode and G > 0.05:
+                G = 0.05
+        return G * self.frame_rate
 
     def _has_collision(self, piece: Piece) -> bool:
         success, new_board = self.convert_piece_to_board(piece)
@@ -438,38 +775,27 @@ class TetrisGame:
         success = self.combine_boards(new_board, self.board)
         return not success
 
-    def _rotate(self, is_clockwise: bool) -> None:
-        new_piece = copy.deepcopy(self.piece)
-        if is_clockwise:
-            new_piece.rotation += 1
-        else:
-            new_piece.rotation += 3
-        new_piece.rotation %= 4
+    def _fits(self, piece: Piece) -> bool:
+        # Same result as not _has_collision, without building a board
+        cells = piece_cells[piece.kind][piece.rotation] + piece.position
+        xs = cells[:, 0]
+        ys = cells[:, 1]
+        if xs.min() < 0 or xs.max() >= 10 or ys.min() < 0 or ys.max() >= 40:
+            return False
+        return not self.board[ys, xs].any()
 
-        # Assign rotation table
-        if new_piece.kind == 0:
-            if is_clockwise:
-                rotation_table = srs_table_clockwise_I[new_piece.rotation]
-            else:
-                rotation_table = (
-                    srs_table_counter_clockwise_I[new_piece.rotation])
-        elif is_clockwise:
-            rotation_table = srs_table_clockwise[new_piece.rotation]
-        else:
-            rotation_table = (
-                    srs_table_counter_clockwise[new_piece.rotation])
-
-        for shift in rotation_table:
-            new_new_piece = copy.deepcopy(new_piece)
-            new_new_piece.position += np.array([shift[0], -shift[1]])
-            if not self._has_collision(new_new_piece) and self.lock_count < 15:
-                self.piece = new_new_piece
-                if self.lock_mode:
-                    self.lock_mode = False
-                    self.lock_count += 1
-                    self.waited_frames = 0
-                self.successful_rotation = True
-                break
+    def _rotate(self, is_clockwise: bool) -> None:
+        if self.lock_count >= 15:
+            return
+        new_piece = rotate_piece(self.board, self.piece, is_clockwise,
+                                 rotation_cache)
+        if new_piece is not None:
+            self.piece = new_piece
+            if self.lock_mode:
+                self.lock_mode = False
+                self.lock_count += 1
+                self.waited_frames = 0
+            self.successful_rotation = True
 
     def _move_left_or_right(self, is_right: bool) -> None:
         new_piece = copy.deepcopy(self.piece)
@@ -555,19 +881,14 @@ class TetrisGame:
         self.drops += 1
         _, new_board = self.convert_piece_to_board(self.piece)
         self.combine_boards(self.board, new_board)
+        self.board_hash ^= hash_board(new_board)
         # Line 550/551 Addition made by Charleston Andrews: 12/2/2023
         self.aggregate_height, self.bumpiness = self._calculate_aggregate_height_bumpiness("regular")
         self.number_holes = self._calculate_number_holes("regular")
         self._generate_new_piece()
 
     def _apply_gravity(self) -> None:
-        if self.lock_mode:
-            G = 0.5
-        else:
-            G = (0.8 - (self.level - 1) * 0.007)**(self.level - 1)
-            if self.soft_drop_mode and G > 0.05:
-                G = 0.05
-        G_frames = G * self.frame_rate
+        G_frames = self.get_gravity_frames()
         self.waited_frames += 1
         if self.waited_frames >= G_frames:
             if self.lock_mode:
@@ -583,18 +904,24 @@ class TetrisGame:
                     self.piece = new_piece
                     self.waited_frames = 0
 
-    def _clear_lines(self) -> None:
+    def _clear_lines(self) -> int:
         lines_cleared = 0
         for i in range(len(self.board)):
             if np.all(self.board[i]):
                 lines_cleared += 1
+                old_rows = self.board[:i + 1]
                 self.board = np.concatenate(
                         (np.zeros((1, 10), dtype=int),
                          np.roll(self.board, 1, axis=0)[1:i + 1],
                          self.board[i + 1:]))
+                # Only rows 0 to i moved, so rehash just those
+                self.board_hash ^= (hash_board(old_rows)
+                                    ^ hash_board(self.board[:i + 1]))
         self._update_scores(lines_cleared)
+        return lines_cleared
 
     def _update_scores(self, lines_cleared: int) -> None:
+        self.lines += lines_cleared
         if lines_cleared == 0 and self.t_spin:
             self.score += 1
         elif lines_cleared == 1:
@@ -618,10 +945,12 @@ class TetrisGame:
             else:
                 self.score += 8
 
-        if lines_cleared == 4:
-            self.had_tetris = True
-        else:
-            self.had_tetris = False
+        # Runs every frame, so only line clears may end a back-to-back run;
+        # pieces that lock without clearing lines in between do not
+        if lines_cleared > 0:
+            if (lines_cleared == 4) != self.had_tetris:
+                self.board_hash ^= zobrist_back_to_back
+            self.had_tetris = lines_cleared == 4
 
         self.t_spin = False
         if self.score >= self.level * (self.level + 1) // 2 * 5:
@@ -732,7 +1061,13 @@ class TetrisGame:
 
     
 
-    def get_next_state(self):
+    def get_next_state(self, cache: AfterstateCache = None):
+        '''
+        Returns a dictionary from (x, rotation) to the board statistics
+        [score, holes, bumpiness, aggregate height] after dropping the current
+        piece there. If a cache is given, statistics are looked up by board
+        hash before being recomputed.
+        '''
         states = {}
         piece_id = self.get_current_piece()
         if (piece_id.kind == 3):
@@ -748,16 +1083,26 @@ class TetrisGame:
 
             temp_game = copy.deepcopy(self)
             for x in range(minimmum_x,maximmum_x+1):
+                if cache is not None:
+                    key = (self.board_hash, piece_id.kind, (x, rotation))
+                    cached = cache.get(key)
+                    if cached is not None:
+                        if cached[0] >= 19:
+                            states[(x,rotation)] = [self.get_score() + cached[1]] + cached[2:]
+                        continue
                 pos = np.array([x,19])
                 piece.position = pos
-                while(not(temp_game._has_collision(piece))):
-                    piece.position[1] +=1
-                piece.position[1] -= 1
+                piece.position[1] += temp_game.get_drop_distance(piece)
                 temp_game.piece = piece
                 temp_holes = temp_game._calculate_number_holes("state")
                 temp_aggregate_height,temp_bumpiness = temp_game._calculate_aggregate_height_bumpiness("state")
-                temp_score = temp_game.get_score() + temp_game._calculate_number_lines()
-                
+                temp_lines = temp_game._calculate_number_lines()
+                temp_score = temp_game.get_score() + temp_lines
+                if cache is not None:
+                    cache.put(key, [int(piece.position[1]), temp_lines,
+                                    temp_holes, temp_bumpiness,
+                                    temp_aggregate_height])
+
                 if(piece.position[1] >= 19):
                     states[(x,rotation)] = [temp_score,temp_holes,temp_bumpiness,temp_aggregate_height]
         return states  
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Opt-in tracing of where time goes. Code marks stages with
+
+    with tracing.span('decide'):
+        ...
+
+which costs next to nothing until tracing is enabled. Once enabled, every
+span is recorded with its start and duration, and the trace is written at
+exit as Chrome trace-event JSON. Open it in chrome://tracing or
+https://ui.perfetto.dev to see nested spans on a timeline.
+'''
+
+from contextlib import contextmanager, nullcontext
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+# Spans recorded after this many are dropped, to bound memory on long runs
+MAX_EVENTS = 2_000_000
+
+_events = None
+_dropped = 0
+_path = None
+
+
+def enable(path: str = 'trace.json') -> None:
+    '''
+    Starts recording spans, to be written to path when the program exits
+    '''
+    global _events, _path
+    if _events is None:
+        atexit.register(write)
+    _events = []
+    _path = path
+
+
+def is_enabled() -> bool:
+    return _events is not None
+
+
+def span(name: str, **args):
+    '''
+    Context manager recording the time spent inside it under name, with
+    optional arguments shown with the span
+    '''
+    if _events is None:
+        return nullcontext()
+    return _span(name, args)
+
+
+@contextmanager
+def _span(name: str, args: dict):
+    global _dropped
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end = time.perf_counter_ns()
+        if len(_events) < MAX_EVENTS:
+            _events.append((name, start, end, threading.get_ident(), args))
+        else:
+            _dropped += 1
+
+
+def enable_from_args(args: [str]) -> None:
+    '''
+    Enables tracing if the arguments contain trace or trace=PATH
+    '''
+    for arg in args:
+        if arg == 'trace':
+            enable()
+        elif arg.startswith('trace='):
+            enable(arg[len('trace='):])
+
+
+def write(path: str = None) -> None:
+    '''
+    Writes the spans recorded so far as Chrome trace-event JSON
+    '''
+    if _events is None:
+        return
+    pid = os.getpid()
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+               'args': {'name': os.path.basename(sys.argv[0])}}]
+    for name, start, end, thread, args in _events:
+        events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': thread,
+                       'ts': start / 1000, 'dur': (end - start) / 1000,
+                       'args': args})
+    with open(path or _path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                   'otherData': {'dropped_spans': _dropped}}, file)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Tunes the weights of the linear evaluator (see features.py) with the
+cross-entropy method. Each generation samples a population of weight vectors
+from a normal distribution, plays them, and refits the distribution to the
+best quarter. Three things keep the number of games down:
+
+* Common random numbers: all candidates of a generation play the same
+  seeds, so they are compared on identical piece sequences.
+* Racing: games are played in rounds, and after each round a candidate
+  whose per-seed difference to the current elite cutoff is confidently
+  negative stops being evaluated.
+* Games of one round run in a process pool.
+
+Example, tuning the features get_utility uses plus two more:
+
+    python3 tune.py -f holes,bumpiness,aggregate_height,line_score,wells
+'''
+
+from evaluate import play_game
+from features import FEATURES
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+# The features get_utility weighs: holes, bumpiness and aggregate height,
+# plus the lines cleared
+DEFAULT_FEATURES = ['holes', 'bumpiness', 'aggregate_height', 'line_score']
+
+
+def make_spec(features: [str], weights: np.ndarray) -> str:
+    '''
+    Returns the evaluate.py policy spec of a weight vector
+    '''
+    return 'linear:' + ','.join(f'{name}={weight:.6g}'
+                                for name, weight in zip(features, weights))
+
+
+def _play(task: tuple) -> (int, int, float):
+    candidate, column, spec, seed, max_pieces, objective = task
+    return candidate, column, play_game(spec, seed, max_pieces)[objective]
+
+
+def _is_losing(scores: np.ndarray, cutoff: np.ndarray, z: float) -> bool:
+    # Paired test on the same seeds: is the candidate confidently worse
+    # than the elite cutoff?
+    differences = scores - cutoff
+    if len(differences) < 2:
+        return False
+    error = differences.std(ddof=1) / np.sqrt(len(differences))
+    return differences.mean() + z * error < 0
+
+
+def tune(features: [str], generations: int = 10, population: int = 24,
+         elite_fraction: float = 0.25, rounds: int = 4,
+         seeds_per_round: int = 2, max_pieces: int = 500,
+         objective: str = 'lines', initial_std: float = 10.0,
+         extra_noise: float = 4.0, z: float = 2.0, workers: int = None,
+         seed: int = 0, log=None) -> dict:
+    '''
+    Runs the cross-entropy method and returns the final distribution mean,
+    the best candidate seen (by its mean objective over its generation's
+    seeds) and the number of games played. log, if given, is called with a
+    dict after every generation.
+    '''
+    unknown = set(features) - set(FEATURES)
+    if unknown:
+        raise ValueError(f'Unknown features: {sorted(unknown)}')
+    rng = np.random.default_rng(seed)
+    mean = np.zeros(len(features))
+    std = np.full(len(features), initial_std)
+    elites = max(2, int(population * elite_fraction))
+    games = 0
+    best = None
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for generation in range(generations):
+            candidates = mean + std * rng.standard_normal((population,
+                                                           len(features)))
+            specs = [make_spec(features, weights) for weights in candidates]
+            seeds = rng.integers(0, 2**31, rounds * seeds_per_round)
+            scores = np.full((population, len(seeds)), np.nan)
+            live = list(range(population))
+            for round in range(rounds):
+                columns = range(round * seeds_per_round,
+                                (round + 1) * seeds_per_round)
+                tasks = [(candidate, column, specs[candidate],
+                          int(seeds[column]), max_pieces, objective)
+                         for candidate in live for column in columns]
+                for candidate, column, value in executor.map(_play, tasks):
+                    scores[candidate, column] = value
+                games += len(tasks)
+                played = (round + 1) * seeds_per_round
+                if round + 1 < rounds and len(live) > elites:
+                    means = scores[live, :played].mean(axis=1)
+                    cutoff = live[np.argsort(-means)[elites - 1]]
+                    live = [candidate for candidate in live
+                            if not _is_losing(scores[candidate, :played],
+                                              scores[cutoff, :played], z)]
+
+            # Candidates that ran every round rank first, by their mean
+            means = np.nanmean(scores, axis=1)
+            finished = ~np.isnan(scores).any(axis=1)
+            order = np.lexsort((-means, ~finished))
+            elite = candidates[order[:elites]]
+            mean = elite.mean(axis=0)
+            noise = extra_noise * max(0.0, 1 - generation / generations)
+            std = np.sqrt(elite.var(axis=0) + noise**2)
+
+            leader = order[0]
+            if best is None or means[leader] > best['mean_' + objective]:
+                best = {'weights': dict(zip(features,
+                                            candidates[leader].tolist())),
+                        'spec': specs[leader],
+                        'mean_' + objective: float(means[leader])}
+            if log is not None:
+                log({'generation': generation, 'games': games,
+                     'survivors': int(finished.sum()),
+                     'elite_mean_' + objective: float(
+                             means[order[:elites]].mean()),
+                     'best_mean_' + objective: float(means[leader]),
+                     'mean': dict(zip(features, mean.tolist())),
+                     'std': dict(zip(features, std.tolist()))})
+
+    return {'features': features,
+            'mean': dict(zip(features, mean.tolist())),
+            'mean_spec': make_spec(features, mean),
+            'best': best,
+            'games': games}
+
+
+def main(args: [str]) -> None:
+    parser = argparse.ArgumentParser(
+            description='Cross-entropy tuning of linear evaluator weights')
+    parser.add_argument('-f', '--features', default=','.join(DEFAULT_FEATURES),
+                        help='comma separated features to weigh, from '
+                        + ', '.join(FEATURES))
+    parser.add_argument('-g', '--generations', default=10, type=int)
+    parser.add_argument('-n', '--population', default=24, type=int)
+    parser.add_argument('-r', '--rounds', default=4, type=int,
+                        help='rounds of games, losers are dropped in between')
+    parser.add_argument('-k', '--seeds-per-round', default=2, type=int)
+    parser.add_argument('-m', '--max-pieces', default=500, type=int,
+                        help='stop each game after this many pieces')
+    parser.add_argument('--objective', default='lines',
+                        choices=['lines', 'score', 'pieces'])
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int,
+                        help='number of worker processes')
+    parser.add_argument('-s', '--seed', default=0, type=int)
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the final JSON report here as well')
+    options = parser.parse_args(args[1:])
+
+    def log(record):
+        print(json.dumps(record), flush=True)
+
+    report = tune(options.features.split(','), options.generations,
+                  options.population, rounds=options.rounds,
+                  seeds_per_round=options.seeds_per_round,
+                  max_pieces=options.max_pieces, objective=options.objective,
+                  workers=options.workers, seed=options.seed, log=log)
+    print(json.dumps(report, indent=2))
+    if options.output is not None:
+        with open(options.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+A vector of games stepped by worker processes, with every game's state and
+observation kept in shared memory. Each worker owns a contiguous slice of
+the games and steps them in place; the driver writes actions into a shared
+array and reads observations as NumPy views, so nothing is pickled per step.
+For example:
+
+    with SharedVectorEnv(64, workers=8, seed=0) as env:
+        observations = env.reset()
+        while True:
+            observations = env.step(choose(observations))
+
+Actions are (x, rotation) placements, played with simple_ai.move. A game
+that ends (or reaches max_pieces) sets its done flag and is replaced by a
+new game in the same step, so the observation next to a done flag is the
+first one of the new game.
+'''
+
+from tetris_game import TetrisGame
+from viewer import SNAPSHOT_SIZE, write_snapshot, read_snapshot
+from multiprocessing import shared_memory
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import numpy as np
+
+# Name, dtype and per-game shape of every shared array. state holds the
+# viewer.py snapshot of each game (board, piece, hold, queue, score, ...).
+FIELDS = [
+    ('state', np.int64, (SNAPSHOT_SIZE,)),
+    ('board', np.uint8, (21, 10)),
+    ('statistics', np.float32, (4,)),
+    ('pieces', np.int32, ()),
+    ('action', np.int8, (2,)),
+    ('reward', np.float32, ()),
+    ('done', np.bool_, ()),
+]
+
+# Commands from the driver to the workers
+_STEP = 0
+_RESET = 1
+_CLOSE = 2
+
+
+def _attach(names: dict, number_games: int) -> (list, dict):
+    # Maps the shared blocks and returns them with NumPy views onto them
+    blocks = []
+    arrays = {}
+    for name, dtype, shape in FIELDS:
+        block = shared_memory.SharedMemory(name=names[name])
+        blocks.append(block)
+        arrays[name] = np.ndarray((number_games,) + shape, dtype=dtype,
+                                  buffer=block.buf)
+    return blocks, arrays
+
+
+class _Slot:
+    # One game with its own copy of the global random state, which draws
+    # the 7-bags, so the games of a worker do not share piece sequences
+    def __init__(self, index: int, number_games: int, seed: int) -> None:
+        self.index = index
+        self.number_games = number_games
+        self.seed = seed
+        self.episodes = 0
+        self.game = TetrisGame(60)
+        self.reset()
+
+    def reset(self) -> None:
+        random.seed(self.seed + self.episodes * self.number_games + self.index)
+        self.episodes += 1
+        self.game.reset()
+        self.random_state = random.getstate()
+
+
+def _publish(slot: _Slot, arrays: dict) -> None:
+    i = slot.index
+    game = slot.game
+    write_snapshot(game, arrays['state'][i])
+    arrays['board'][i] = game.get_simple_board()
+    arrays['statistics'][i] = game.get_board_statistics()
+    arrays['pieces'][i] = game.get_drops()
+
+
+def _worker(names: dict, number_games: int, games: range, seed: int,
+            max_pieces: int, command, barrier) -> None:
+    from simple_ai import move
+
+    blocks, arrays = _attach(names, number_games)
+    slots = [_Slot(i, number_games, seed) for i in games]
+    try:
+        while True:
+            barrier.wait()
+            if command.value == _CLOSE:
+                break
+            for slot in slots:
+                i = slot.index
+                if command.value == _RESET:
+                    slot.reset()
+                    arrays['reward'][i] = 0
+                    arrays['done'][i] = False
+                else:
+                    random.setstate(slot.random_state)
+                    game = slot.game
+                    score = game.get_score()
+                    x, rotation = arrays['action'][i]
+                    move(game, int(x), int(rotation))
+                    slot.random_state = random.getstate()
+                    done = game.is_over() or (max_pieces is not None and
+                                              game.get_drops() >= max_pieces)
+                    arrays['reward'][i] = game.get_score() - score
+                    arrays['done'][i] = done
+                    if done:
+                        slot.reset()
+                _publish(slot, arrays)
+            barrier.wait()
+    except BaseException:
+        # Wakes the driver instead of leaving it waiting forever
+        barrier.abort()
+        raise
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+
+
+class SharedVectorEnv:
+    '''
+    Steps number_games games in worker processes. Game i of episode k is
+    seeded with seed + k * number_games + i, so runs are reproducible for a
+    given seed regardless of the number of workers. step and reset return
+    a dictionary of the shared arrays by FIELDS name, one row per game.
+    These are views, not copies: they change on the next step.
+    '''
+
+    def __init__(self, number_games: int, workers: int = None,
+                 seed: int = 0, max_pieces: int = None) -> None:
+        workers = min(workers or os.cpu_count(), number_games)
+        self.number_games = number_games
+        self.blocks = []
+        self.arrays = {}
+        for name, dtype, shape in FIELDS:
+            size = max(1, number_games * int(np.prod(shape, dtype=int))
+                       * np.dtype(dtype).itemsize)
+            block = shared_memory.SharedMemory(create=True, size=size)
+            self.blocks.append(block)
+            self.arrays[name] = np.ndarray((number_games,) + shape,
+                                           dtype=dtype, buffer=block.buf)
+        names = {name: block.name
+                 for (name, _, _), block in zip(FIELDS, self.blocks)}
+
+        self.command = multiprocessing.Value('b', _RESET, lock=False)
+        self.barrier = multiprocessing.Barrier(workers + 1)
+        self.processes = []
+        for games in np.array_split(np.arange(number_games), workers):
+            process = multiprocessing.Process(
+                    target=_worker,
+                    args=(names, number_games,
+                          range(games[0], games[-1] + 1), seed, max_pieces,
+                          self.command, self.barrier),
+                    daemon=True)
+            process.start()
+            self.processes.append(process)
+        self.closed = False
+
+    def _run(self, command: int) -> dict:
+        if self.closed:
+            raise RuntimeError('SharedVectorEnv is closed')
+        self.command.value = command
+        try:
+            # Workers start on the first wait and are done at the second
+            self.barrier.wait()
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            self.close()
+            raise RuntimeError('A SharedVectorEnv worker failed')
+        return self.arrays
+
+    def reset(self) -> dict:
+        '''
+        Starts a new game everywhere and returns the observations
+        '''
+        return self._run(_RESET)
+
+    def step(self, actions: np.ndarray) -> dict:
+        '''
+        Plays one (x, rotation) placement per game and returns the
+        observations, rewards and done flags
+        '''
+        self.arrays['action'][:] = actions
+        return self._run(_STEP)
+
+    def get_mirror(self, index: int) -> TetrisGame:
+        '''
+        Returns a TetrisGame showing game index as of the last step, for
+        rendering or for policies that take a game. It does not share the
+        worker's random state, so stepping it draws different pieces.
+        '''
+        game = TetrisGame(60)
+        read_snapshot(self.arrays['state'][index], game)
+        return game
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if not self.barrier.broken:
+            self.command.value = _CLOSE
+            self.barrier.wait()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        # The views must go before the blocks can be closed
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.close()
+
+
+def bench(number_games: int, workers: int, seconds: float) -> dict:
+    '''
+    Plays random placements for the given time and returns the placements
+    per second
+    '''
+    rng = np.random.default_rng(0)
+    with SharedVectorEnv(number_games, workers) as env:
+        env.reset()
+        placements = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            actions = np.stack([rng.integers(0, 10, number_games),
+                                rng.integers(0, 4, number_games)], axis=-1)
+            env.step(actions)
+            placements += number_games
+        duration = time.perf_counter() - start
+    return {'games': number_games, 'workers': workers,
+            'placements_per_second': placements / duration}
+
+
+def main(args: [str]) -> None:
+    if len(args) < 2 or args[1] != 'bench':
+        print(f'usage: {args[0]} bench [GAMES] [WORKERS] [SECONDS]')
+        sys.exit(2)
+    number_games = int(args[2]) if len(args) > 2 else 64
+    workers = int(args[3]) if len(args) > 3 else os.cpu_count()
+    seconds = float(args[4]) if len(args) > 4 else 10.0
+    print(json.dumps(bench(number_games, workers, seconds)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2023 Charleston Andrews, Caleb Butler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from tetris_game import TetrisGame, Piece
+import multiprocessing
+import numpy as np
+
+# Layout of a game-state snapshot, stored as int64 values in shared memory
+_SEQUENCE = 0
+_BOARD = slice(1, 401)
+_KIND = 401
+_X = 402
+_Y = 403
+_ROTATION = 404
+_HOLD = 405
+_LEVEL = 406
+_SCORE = 407
+_OVER = 408
+_AGGREGATE_HEIGHT = 409
+_BUMPINESS = 410
+_HOLES = 411
+_QUEUE_LENGTH = 412
+_QUEUE = slice(413, 419)
+SNAPSHOT_SIZE = 419
+
+
+def write_snapshot(game: TetrisGame, snapshot: np.ndarray) -> None:
+    '''
+    Writes everything the Renderer shows about game into snapshot, an int64
+    array of SNAPSHOT_SIZE values. The sequence number is left alone.
+    '''
+    piece = game.get_current_piece()
+    next_pieces = game.get_next_pieces()
+    snapshot[_BOARD] = game.get_board().ravel()
+    snapshot[_KIND] = piece.kind
+    snapshot[_X] = piece.position[0]
+    snapshot[_Y] = piece.position[1]
+    snapshot[_ROTATION] = piece.rotation
+    snapshot[_HOLD] = game.get_hold_piece()
+    snapshot[_LEVEL] = game.get_level()
+    snapshot[_SCORE] = game.get_score()
+    snapshot[_OVER] = game.is_over()
+    snapshot[_AGGREGATE_HEIGHT] = game.get_aggregate_height()
+    snapshot[_BUMPINESS] = game.get_bumpiness()
+    snapshot[_HOLES] = game.get_number_holes()
+    snapshot[_QUEUE_LENGTH] = len(next_pieces)
+    snapshot[_QUEUE][:len(next_pieces)] = next_pieces
+
+
+def read_snapshot(snapshot: np.ndarray, game: TetrisGame) -> None:
+    '''
+    Overwrites the displayed state of game with the contents of snapshot, so
+    a Renderer bound to game draws the snapshotted game.
+    '''
+    game.board = snapshot[_BOARD].reshape((40, 10)).astype(int)
+    game.piece = Piece(int(snapshot[_KIND]),
+                       np.array([snapshot[_X], snapshot[_Y]], dtype=int),
+                       int(snapshot[_ROTATION]))
+    game.hold_piece = int(snapshot[_HOLD])
+    game.level = int(snapshot[_LEVEL])
+    game.score = int(snapshot[_SCORE])
+    game.is_game_over = bool(snapshot[_OVER])
+    game.aggregate_height = int(snapshot[_AGGREGATE_HEIGHT])
+    game.bumpiness = int(snapshot[_BUMPINESS])
+    game.number_holes = int(snapshot[_HOLES])
+    game.piece_queue = [int(kind) for kind
+                        in snapshot[_QUEUE][:snapshot[_QUEUE_LENGTH]]]
+
+
+def _render_loop(shared, running, frame_rate: int) -> None:
+    # Runs in the render process, which is the only one that touches pygame
+    from renderer import Renderer
+    import pygame
+
+    snapshot = np.frombuffer(shared.get_obj(), dtype=np.int64)
+    local = np.zeros(SNAPSHOT_SIZE, dtype=np.int64)
+    game = TetrisGame(frame_rate)
+    renderer = Renderer(game)
+    renderer.setup()
+    clock = pygame.time.Clock()
+    sequence = 0
+    while running.value:
+        with shared.get_lock():
+            if snapshot[_SEQUENCE] != sequence:
+                local[:] = snapshot
+        if local[_SEQUENCE] != sequence:
+            sequence = local[_SEQUENCE]
+            read_snapshot(local, game)
+        renderer.rerender()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running.value = False
+        clock.tick(frame_rate)
+    pygame.quit()
+
+
+class ViewerProcess:
+    '''
+    Drop-in replacement for Renderer that draws in its own process. Calling
+    rerender only copies a snapshot of the game into shared memory, and the
+    render process redraws the latest snapshot at a steady frame rate. The
+    game loop therefore never waits on pygame, and AI think time never
+    freezes the window. Use is_running to find out if the window was closed.
+    '''
+
+    def __init__(self, game: TetrisGame, frame_rate: int = 60) -> None:
+        self.game = game
+        self.frame_rate = frame_rate
+        self.shared = multiprocessing.Array('q', SNAPSHOT_SIZE)
+        self.snapshot = np.frombuffer(self.shared.get_obj(), dtype=np.int64)
+        self.local = np.zeros(SNAPSHOT_SIZE, dtype=np.int64)
+        self.running = multiprocessing.Value('b', True, lock=False)
+        self.process = None
+
+    def get_game(self) -> TetrisGame:
+        '''
+        Getter for game object
+        '''
+        return self.game
+
+    def set_game(self, game: TetrisGame) -> None:
+        '''
+        Setter for game object
+        '''
+        self.game = game
+
+    def setup(self) -> None:
+        '''
+        Starts the render process and publishes the first frame
+        '''
+        self.rerender()
+        self.process = multiprocessing.Process(
+                target=_render_loop,
+                args=(self.shared, self.running, self.frame_rate),
+                daemon=True)
+        self.process.start()
+
+    def rerender(self) -> None:
+        '''
+        Publishes the current state of the game to the render process
+        '''
+        write_snapshot(self.game, self.local)
+        with self.shared.get_lock():
+            self.local[_SEQUENCE] = self.snapshot[_SEQUENCE] + 1
+            self.snapshot[:] = self.local
+
+    def is_running(self) -> bool:
+        '''
+        Returns False once the window has been closed
+        '''
+        return bool(self.running.value)
+
+    def close(self) -> None:
+        '''
+        Stops the render process
+        '''
+        self.running.value = False
+        if self.process is not None:
+            self.process.join()
+            self.process = None
+
+
+class HeadlessRenderer:
+    '''
+    Drop-in replacement for Renderer that draws nothing, for runs without a
+    display. pygame is never imported. is_running is always True, so the
+    game loop runs until it is interrupted.
+    '''
+
+    def __init__(self, game: TetrisGame) -> None:
+        self.game = game
+
+    def get_game(self) -> TetrisGame:
+        return self.game
+
+    def set_game(self, game: TetrisGame) -> None:
+        self.game = game
+
+    def setup(self) -> None:
+        pass
+
+    def rerender(self) -> None:
+        pass
+
+    def is_running(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass